@@ -16,7 +16,7 @@ from model_utils import check_and_download_models  # noqa: E402
 from utils import get_base_parser, get_savepath, update_parser  # noqa: E402
 
 from blazeface_utils import compute_blazeface, crop_blazeface  # noqa: E402
-from face_detection_adas_util import compute_face_detection_adas  # noqa
+from face_detection_adas_util import compute_face_detection_adas, prepare_priors  # noqa
 import hopenet_utils as hut
 
 logger = getLogger(__name__)
@@ -65,6 +65,9 @@ HEAD_POSE_IMAGE_SIZE = 224
 
 IMAGE_SIZE = 62
 
+# faces are first searched in this upper part of the person crop (0: search the whole crop)
+HEAD_REGION_RATIO = 0.0
+
 HEAD_POSE_ESTIMATION = False
 PROFILE = False
 
@@ -74,7 +77,10 @@ PROFILE = False
 
 def setup_detector(net):
     if DETECTION_MODEL_TYPE == 'blazeface':
-        from blazeface_utils import compute_blazeface  # noqa
+        from blazeface_utils import compute_blazeface, load_anchors  # noqa
+
+        # anchors are loaded once and kept by blazeface_utils
+        load_anchors(BLAZEFACE_ANCHOR_PATH)
 
         def _detector(img):
             detections = compute_blazeface(
@@ -108,6 +114,7 @@ def setup_detector(net):
         model_info = {
             'net': net,
             'prior_box': prior_box,
+            'priors': prepare_priors(prior_box),
         }
 
         def _detector(img):
@@ -135,6 +142,28 @@ def setup_detector(net):
     return detector
 
 
+def detect_face(detector, frame, head_ratio):
+    # search the upper band of a standing person first, it is resized into
+    # the same detector input so faces are found at a higher resolution
+    h = frame.shape[0]
+    band = int(round(h * head_ratio))
+    if 0 < band < h and frame.shape[1] < h:
+        detections = detector(frame[:band])
+        if len(detections) > 0:
+            scale = band / h
+            return [ailia.DetectorObject(
+                category=d.category,
+                prob=d.prob,
+                x=d.x,
+                y=d.y * scale,
+                w=d.w,
+                h=d.h * scale,
+            ) for d in detections]
+
+    # fallback to the whole crop
+    return detector(frame)
+
+
 def head_pose_estimation(crop_img, hp_estimator):
     img = cv2.resize(crop_img, (HEAD_POSE_IMAGE_SIZE, HEAD_POSE_IMAGE_SIZE))
     mean = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape((1, 1, 1, 3))
@@ -179,11 +208,12 @@ def recognize_age_gender_retail(age_gender, frame):
     net = age_gender["net"]
     detector = age_gender["detector"]
     hp_estimator = age_gender["hp_estimator"]
+    head_ratio = age_gender.get("head_ratio", HEAD_REGION_RATIO)
 
     # detect face
     if PROFILE:
         start = int(round(time.time() * 1000))
-    detections = detector(frame)
+    detections = detect_face(detector, frame, head_ratio)
     if PROFILE:
         end = int(round(time.time() * 1000))
         logger.info(f'\tface detection processing time {end - start} ms')
@@ -232,7 +262,7 @@ def recognize_age_gender_retail(age_gender, frame):
     return None, None, frame
 
 
-def create_age_gender_retail(env_id):
+def create_age_gender_retail(env_id, head_ratio=HEAD_REGION_RATIO):
     # model files check and download
     logger.info('=== age-gender-recognition model ===')
     check_and_download_models(
@@ -262,7 +292,7 @@ def create_age_gender_retail(env_id):
     else:
         hp_estimator = None
 
-    return {"net": net, "detector": detector, "hp_estimator": hp_estimator}
+    return {"net": net, "detector": detector, "hp_estimator": hp_estimator, "head_ratio": head_ratio}
 
 
 if __name__ == '__main__':
@@ -10,6 +10,20 @@ from math_utils import sigmoid  # noqa: E402
 
 DEFAULT_MIN_SCORE_THRESH = 0.75
 
+# anchors per anchor file, loaded once
+_anchors = {}
+
+# letterbox buffers per input shape, reused between calls
+_letterbox_buffers = {}
+
+
+def load_anchors(anchor_path):
+    anchors = _anchors.get(anchor_path)
+    if anchors is None:
+        anchors = np.load(anchor_path).astype(np.float32)
+        _anchors[anchor_path] = anchors
+    return anchors
+
 
 def plot_detections(
         img, detections, with_keypoints=True, save_image_path='result.png'
@@ -81,7 +95,7 @@ def decode_boxes(raw_boxes, back, anchors):
 
 
 def intersect(box_a, box_b):
-    """ We resize both arrays to [A,B,2] without new malloc:
+    """ We broadcast both arrays to [A,B,2] without new malloc:
     [A,2] -> [A,1,2] -> [A,B,2]
     [B,2] -> [1,B,2] -> [A,B,2]
     Then we compute the area of intersect between box_a and box_b.
@@ -91,24 +105,9 @@ def intersect(box_a, box_b):
     Return:
       (array) intersection area, Shape: [A,B].
     """
-    A = box_a.shape[0]
-    B = box_b.shape[0]
-    # max_xy = (np.expand_dims(box_a[:, 2:], axis=1).expand(A, B, 2),
-    #           np.expand_dims(box_b[:, 2:], axis=0).expand(A, B, 2)).min()
-    # min_xy = (np.expand_dims(box_a[:, :2], axis=1).expand(A, B, 2),
-    #           np.expand_dims(box_b[:, :2], axis=0).expand(A, B, 2)).max()
-
-    max_xy = np.minimum(
-        np.repeat(np.expand_dims(box_a[:, 2:], axis=1), B, axis=1),
-        np.repeat(np.expand_dims(box_b[:, 2:], axis=0), A, axis=0),
-        
-    )
-    min_xy = np.maximum(
-        np.repeat(np.expand_dims(box_a[:, :2], axis=1), B, axis=1),
-        np.repeat(np.expand_dims(box_b[:, :2], axis=0), A, axis=0),
-        
-    )
-    
+    max_xy = np.minimum(box_a[:, None, 2:], box_b[None, :, 2:])
+    min_xy = np.maximum(box_a[:, None, :2], box_b[None, :, :2])
+
     inter = np.clip((max_xy - min_xy), 0, None)
     return inter[:, :, 0] * inter[:, :, 1]
 
@@ -126,22 +125,8 @@ def jaccard(box_a, box_b):
         jaccard overlap: (array) Shape: [box_a.size(0), box_b.size(0)]
     """
     inter = intersect(box_a, box_b)
-    area_a = np.repeat(
-        np.expand_dims(
-            (box_a[:, 2]-box_a[:, 0]) * (box_a[:, 3]-box_a[:, 1]),
-            axis=1
-        ),
-        inter.shape[1],
-        axis=1
-    )  # [A,B]
-    area_b = np.repeat(
-        np.expand_dims(
-            (box_b[:, 2]-box_b[:, 0]) * (box_b[:, 3]-box_b[:, 1]),
-            axis=0
-        ),
-        inter.shape[0],
-        axis=0
-    )  # [A,B]
+    area_a = ((box_a[:, 2]-box_a[:, 0]) * (box_a[:, 3]-box_a[:, 1]))[:, None]  # [A,1]
+    area_b = ((box_b[:, 2]-box_b[:, 0]) * (box_b[:, 3]-box_b[:, 1]))[None, :]  # [1,B]
     union = area_a + area_b - inter
     return inter / union  # [A,B]
 
@@ -162,19 +147,22 @@ def weighted_non_max_suppression(detections):
     # argsort(-x) returns the descending order version of argsort(x)
     remaining = np.argsort(-detections[:, 16])
 
+    # The overlaps of all pairs are computed once, the at most 896
+    # detections above the score threshold keep the matrix small.
+    all_ious = jaccard(detections[:, :4], detections[:, :4])
+
     while len(remaining) > 0:
         detection = detections[remaining[0]]
 
-        # Compute the overlap between the first box and the other 
-        # remaining boxes. (Note that the other_boxes also include
-        # the first_box.)
-        first_box = detection[:4]
-        other_boxes = detections[remaining, :4]
-        ious = overlap_similarity(first_box, other_boxes)
+        # The overlap between the first box and the other remaining
+        # boxes. (Note that the other boxes also include the first box.)
+        ious = all_ious[remaining[0], remaining]
 
         # If two detections don't overlap enough, they are considered
-        # to be from different faces.
+        # to be from different faces. The first box is always taken,
+        # even if it has no area and its overlap is not a number.
         mask = ious > min_suppression_threshold
+        mask[0] = True
         overlapping = remaining[mask]
         remaining = remaining[~mask]
 
@@ -198,10 +186,9 @@ def postprocess(preds_ailia, anchor_path='anchors.npy', back=False, min_score_th
     raw_box = preds_ailia[0]  # (1, 896, 16)
     raw_score = preds_ailia[1]  # (1, 896, 1)
 
-    anchors = np.load(anchor_path).astype(np.float32)
+    anchors = load_anchors(anchor_path)
     score_thresh = 100.0
     
-    detection_boxes = decode_boxes(raw_box, back, anchors)  # (1, 896, 16)
     raw_score = np.clip(raw_score, -score_thresh, score_thresh)  # (1, 896, 1)
     detection_scores = np.squeeze(sigmoid(raw_score), axis=-1)  # (1, 896)
     
@@ -211,10 +198,11 @@ def postprocess(preds_ailia, anchor_path='anchors.npy', back=False, min_score_th
     mask = detection_scores >= min_score_thresh  # (1, 896)
 
     # Because each image from the batch can have a different number of
-    # detections, process them one at a time using a loop.
+    # detections, process them one at a time using a loop. Only the boxes
+    # above the threshold are decoded.
     detections = []
     for i in range(raw_box.shape[0]):
-        boxes = detection_boxes[i, mask[i]]
+        boxes = decode_boxes(raw_box[i, mask[i]], back, anchors[mask[i]])
         scores = np.expand_dims(detection_scores[i, mask[i]], axis=-1)
         detections.append(np.concatenate((boxes, scores), axis=-1))
 
@@ -236,7 +224,10 @@ def compute_blazeface_with_keypoint(detector, frame, anchor_path='anchors.npy',
         BLAZEFACE_INPUT_IMAGE_WIDTH = 128
 
     # preprocessing
-    image = letterbox_convert(frame, (BLAZEFACE_INPUT_IMAGE_HEIGHT, BLAZEFACE_INPUT_IMAGE_WIDTH))
+    shape = (BLAZEFACE_INPUT_IMAGE_HEIGHT, BLAZEFACE_INPUT_IMAGE_WIDTH)
+    if shape not in _letterbox_buffers:
+        _letterbox_buffers[shape] = np.zeros(shape + (3,), np.uint8)
+    image = letterbox_convert(frame, shape, out=_letterbox_buffers[shape])
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     image = image.transpose((2, 0, 1))  # channel first
     image = image[np.newaxis, :, :, :]  # (batch_size, channel, h, w)
@@ -49,15 +49,26 @@ def convert_to_detector_object(bboxes, scores, im_w, im_h):
 # Main functions
 # ======================
 
-def preprocess(img):
+def preprocess(img, model_info=None):
     #img = cv2.resize(img, (IMAGE_WIDTH, IMAGE_HEIGHT), interpolation=cv2.INTER_LINEAR)
-    img = letterbox_convert(img, (IMAGE_HEIGHT, IMAGE_WIDTH))
+    if model_info is None:
+        img = letterbox_convert(img, (IMAGE_HEIGHT, IMAGE_WIDTH))
 
-    img = img.transpose(2, 0, 1)  # HWC -> CHW
-    img = np.expand_dims(img, axis=0)
-    img = img.astype(np.float32)
+        img = img.transpose(2, 0, 1)  # HWC -> CHW
+        img = np.expand_dims(img, axis=0)
+        img = img.astype(np.float32)
 
-    return img
+        return img
+
+    # letterbox and network input buffers are kept in model_info and reused
+    if 'letterbox_buffer' not in model_info:
+        model_info['letterbox_buffer'] = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH, 3), np.uint8)
+        model_info['input_buffer'] = np.zeros((1, 3, IMAGE_HEIGHT, IMAGE_WIDTH), np.float32)
+    img = letterbox_convert(img, (IMAGE_HEIGHT, IMAGE_WIDTH), out=model_info['letterbox_buffer'])
+    input_buffer = model_info['input_buffer']
+    np.copyto(input_buffer[0], img.transpose(2, 0, 1))  # HWC -> CHW
+
+    return input_buffer
 
 
 def decode_bbox(mbox_loc, mbox_priorbox, variances):
@@ -95,26 +106,76 @@ def decode_bbox(mbox_loc, mbox_priorbox, variances):
     return bboxes
 
 
+def prepare_priors(prior_box):
+    """
+    Precompute the prior box centers and sizes used by decode_bbox, so
+    that they are computed once per detector instead of once per call.
+    """
+    mbox_priorbox = prior_box[0].reshape(-1, 4)
+    variances = prior_box[1].reshape(-1, 4)
+
+    prior_width = mbox_priorbox[:, 2] - mbox_priorbox[:, 0]
+    prior_height = mbox_priorbox[:, 3] - mbox_priorbox[:, 1]
+    prior_center_x = 0.5 * (mbox_priorbox[:, 2] + mbox_priorbox[:, 0])
+    prior_center_y = 0.5 * (mbox_priorbox[:, 3] + mbox_priorbox[:, 1])
+
+    return {
+        'width': prior_width,
+        'height': prior_height,
+        'center_x': prior_center_x,
+        'center_y': prior_center_y,
+        'variances': variances,
+    }
+
+
+def decode_selected_bbox(mbox_loc, priors, idx):
+    """
+    Same as decode_bbox, for the priors `idx` only.
+    """
+    mbox_loc = mbox_loc.reshape(-1, 4)[idx]
+    prior_width = priors['width'][idx]
+    prior_height = priors['height'][idx]
+    variances = priors['variances'][idx]
+
+    decode_bbox_center_x = mbox_loc[:, 0] * prior_width * variances[:, 0]
+    decode_bbox_center_x += priors['center_x'][idx]
+    decode_bbox_center_y = mbox_loc[:, 1] * prior_height * variances[:, 1]
+    decode_bbox_center_y += priors['center_y'][idx]
+    decode_bbox_width = np.exp(mbox_loc[:, 2] * variances[:, 2])
+    decode_bbox_width *= prior_width
+    decode_bbox_height = np.exp(mbox_loc[:, 3] * variances[:, 3])
+    decode_bbox_height *= prior_height
+
+    bboxes = np.empty((len(mbox_loc), 4), dtype=decode_bbox_center_x.dtype)
+    bboxes[:, 0] = decode_bbox_center_x - 0.5 * decode_bbox_width
+    bboxes[:, 1] = decode_bbox_center_y - 0.5 * decode_bbox_height
+    bboxes[:, 2] = decode_bbox_center_x + 0.5 * decode_bbox_width
+    bboxes[:, 3] = decode_bbox_center_y + 0.5 * decode_bbox_height
+
+    return bboxes
+
+
 def compute_face_detection_adas(model_info, img):
     score_th = THRESHOLD
     nms_th = IOU
 
     net = model_info['net']
-    prior_box = model_info['prior_box']
+    if 'priors' not in model_info:
+        model_info['priors'] = prepare_priors(model_info['prior_box'])
+    priors = model_info['priors']
 
-    preprocess_img = preprocess(img)
+    preprocess_img = preprocess(img, model_info)
 
     # feedforward
     output = net.predict([preprocess_img])
     mbox_loc, mbox_conf = output
 
-    bboxes = decode_bbox(mbox_loc[0], prior_box[0], prior_box[1])
-
+    # decode only the priors above the threshold
     mbox_conf = mbox_conf[0].reshape(-1, 2)
     cls_idx = 1
-    i = mbox_conf[:, cls_idx] >= score_th
-    bboxes = bboxes[i]
-    scores = mbox_conf[i][:, 1]
+    i = np.flatnonzero(mbox_conf[:, cls_idx] >= score_th)
+    bboxes = decode_selected_bbox(mbox_loc[0], priors, i)
+    scores = mbox_conf[i, 1]
 
     bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * IMAGE_WIDTH
     bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * IMAGE_HEIGHT
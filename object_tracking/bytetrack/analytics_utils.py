@@ -0,0 +1,454 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# logger
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+__all__ = [
+    'AnalyticsSender',
+    'EventSpool',
+    'GA_ENDPOINT',
+    'MAX_EVENTS_PER_REQUEST',
+]
+
+GA_ENDPOINT = "https://www.google-analytics.com/mp/collect"
+
+# the measurement protocol accepts at most 25 events per request
+MAX_EVENTS_PER_REQUEST = 25
+
+# polling interval used so that the worker notices flush and stop requests
+POLL_INTERVAL = 0.1
+
+# results of one request
+SEND_OK = 0
+SEND_RETRY = 1
+SEND_REJECTED = 2
+
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+
+
+class _End(object):
+    """Marker which asks the worker to send what is left and exit."""
+
+
+def _fsync_dir(directory):
+    # make created, renamed and removed files durable, not supported on windows
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EventSpool(object):
+    """Append-only spool of events on disk, read back in order.
+
+    Events are appended as json lines to segment files in `directory`.
+    The segment being written is switched when it reaches `segment_bytes`,
+    and each process starts a new one, so that a line torn by a crash is
+    never appended to. Writes are buffered and flushed with fsync at most
+    every `sync_interval` seconds by `sync()`.
+
+    `read()` returns the oldest events after the committed cursor and the
+    cursor behind them. `commit()` stores that cursor once the events have
+    been delivered and removes the segments which were read completely.
+    When the segments take more than `max_bytes`, the oldest are removed
+    even if they were not read, and their events are counted in `dropped`.
+    Segments are made smaller when `max_bytes` is less than two of them.
+    """
+
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024, sync_interval=1.0):
+        self.directory = directory
+        # at least two segments fit, so that the bound is kept while one is written
+        self.segment_bytes = min(segment_bytes, max_bytes // 2)
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.dropped = 0
+        # number of drops of unread segments, and its value at the last read
+        self.drops = 0
+        self.read_drops = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        self.sizes = {seg: os.path.getsize(self._path(seg)) for seg in self.segments}
+
+        # committed read position, (segment, byte offset)
+        self.cursor = self._load_cursor()
+
+        self.file = None
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+        last = self.segments[-1] if len(self.segments) > 0 else 0
+        self._open_segment(max(last, self.cursor[0]) + 1)
+
+        # the segment of the cursor may have been dropped
+        if self.cursor[0] not in self.sizes:
+            self.cursor = (min(seg for seg in self.segments if seg > self.cursor[0]), 0)
+        self.pending = self._count_after(self.cursor)
+
+    def _path(self, seg):
+        return os.path.join(self.directory, "%08d%s" % (seg, SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                seg, offset = f.read().split()
+            return int(seg), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _count_lines(self, seg, offset):
+        with open(self._path(seg), "rb") as f:
+            f.seek(offset)
+            return sum(1 for line in f if line.endswith(b"\n"))
+
+    def _count_after(self, cursor):
+        return sum(self._count_lines(seg, cursor[1] if seg == cursor[0] else 0)
+                   for seg in self.segments if seg >= cursor[0])
+
+    def _open_segment(self, seg):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.file = open(self._path(seg), "ab")
+        self.segments.append(seg)
+        self.sizes[seg] = 0
+        _fsync_dir(self.directory)
+
+    def append(self, event):
+        line = (json.dumps({"t": int(time.time() * 1000000), "e": event}) + "\n").encode("utf-8")
+        with self.lock:
+            seg = self.segments[-1]
+            if self.sizes[seg] > 0 and self.sizes[seg] + len(line) > self.segment_bytes:
+                self._open_segment(seg + 1)
+                seg = seg + 1
+                self._drop_oldest()
+            self.file.write(line)
+            self.sizes[seg] += len(line)
+            self.pending += 1
+            self.unsynced = True
+
+    def _drop_oldest(self):
+        # keep room for the segment which has just been opened
+        while sum(self.sizes.values()) + self.segment_bytes > self.max_bytes and len(self.segments) > 1:
+            seg = self.segments.pop(0)
+            offset = self.cursor[1] if seg == self.cursor[0] else 0
+            if seg >= self.cursor[0]:
+                lost = self._count_lines(seg, offset)
+                self.dropped += lost
+                self.pending -= lost
+                self.drops += 1
+                logger.warning("analytics spool is full, dropped " + str(lost) + " events")
+            os.remove(self._path(seg))
+            del self.sizes[seg]
+            if self.cursor[0] <= seg:
+                self.cursor = (self.segments[0], 0)
+        _fsync_dir(self.directory)
+
+    def sync(self, force=False):
+        with self.lock:
+            if not self.unsynced or (not force and time.monotonic() - self.last_sync < self.sync_interval):
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+            self.last_sync = time.monotonic()
+
+    def read(self, max_events, max_span=None):
+        """Return (events, timestamp of the first event, cursor after them, number of broken lines skipped).
+
+        The events span at most `max_span` seconds, so that one request
+        timestamp describes all of them.
+        """
+        events = []
+        first_time = None
+        with self.lock:
+            self.file.flush()
+            self.read_drops = self.drops
+            seg, offset = self.cursor
+            skipped = 0
+            while len(events) < max_events and seg in self.sizes:
+                with open(self._path(seg), "rb") as f:
+                    f.seek(offset)
+                    while len(events) < max_events:
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            offset += len(line)
+                            skipped += 1
+                            continue
+                        if first_time is not None and max_span is not None and \
+                                record["t"] - first_time > max_span * 1000000:
+                            return events, first_time, (seg, offset), skipped
+                        if first_time is None:
+                            first_time = record["t"]
+                        events.append(record["e"])
+                        offset += len(line)
+                if seg == self.segments[-1] or len(events) >= max_events:
+                    break
+                # a torn line at the end of an old segment is never completed
+                seg, offset = self.segments[self.segments.index(seg) + 1], 0
+        return events, first_time, (seg, offset), skipped
+
+    def commit(self, cursor, count):
+        """Mark the `count` events before `cursor`, returned by the last `read()`, as delivered."""
+        with self.lock:
+            if cursor[0] < self.cursor[0]:
+                # the segments were dropped while their events were being sent
+                self.dropped -= count
+                return
+            if self.drops != self.read_drops:
+                # the first segments of the events were dropped while they
+                # were being sent, those events were delivered, not lost
+                self.file.flush()
+                pending = self._count_after(cursor)
+                self.dropped -= count - (self._count_after(self.cursor) - pending)
+                self.pending = pending
+            else:
+                self.pending = self.pending - count
+            self.cursor = cursor
+            path = os.path.join(self.directory, CURSOR_FILE)
+            with open(path + ".tmp", "w") as f:
+                f.write("%d %d" % cursor)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            if self.segments[0] < cursor[0]:
+                while self.segments[0] < cursor[0]:
+                    seg = self.segments.pop(0)
+                    os.remove(self._path(seg))
+                    del self.sizes[seg]
+                _fsync_dir(self.directory)
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class AnalyticsSender(object):
+    """Send measurement protocol events from a worker thread.
+
+    `send()` only queues the event and never blocks the caller; when the
+    bounded queue is full the event is dropped and counted in `dropped`.
+    The worker posts the events in batches of up to `batch_size`, as soon
+    as a batch is full or `flush_interval` seconds after its first event.
+    Failed requests are retried with exponential backoff starting at
+    `backoff` seconds. All requests share one pooled HTTP session and one
+    client id, so the events of a process belong to the same client.
+    `endpoint` can point to a local server for testing.
+
+    With a `spool` (EventSpool), events are stored on disk instead of the
+    in-memory queue and are never given up because of network errors: the
+    worker keeps retrying, with the backoff growing up to `max_backoff`
+    seconds, and delivers them in order once the endpoint is reachable.
+    Events still in the spool at `close()` are sent by the next run.
+    """
+
+    def __init__(self, api_secret, measurement_id, endpoint=GA_ENDPOINT, client_id=None,
+                 batch_size=MAX_EVENTS_PER_REQUEST, flush_interval=1.0, max_retries=5,
+                 backoff=0.5, max_backoff=60.0, timeout=10.0, queue_size=10000, spool=None):
+        self.url = "%s?api_secret=%s&measurement_id=%s" % (endpoint, api_secret, measurement_id)
+        self.client_id = client_id if client_id is not None else str(uuid.uuid4())
+        self.batch_size = min(batch_size, MAX_EVENTS_PER_REQUEST)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.spool = spool
+
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.closing = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        if spool is not None:
+            target = self._spool_worker
+        else:
+            target = self._worker
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def send(self, name, params=None):
+        event = {"name": name, "params": params if params is not None else {}}
+        if self.spool is not None:
+            self.spool.append(event)
+            return True
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout=10.0):
+        """Send the queued events, giving up after `timeout` seconds.
+
+        The events which are not sent by then are counted in `failed`. After
+        the timeout, close waits at most for the request in flight, which
+        takes up to the request `timeout` given to the constructor.
+        """
+        self.closing.set()
+        deadline = time.monotonic() + timeout
+        try:
+            # the queue may be full during an outage
+            self.queue.put(_End(), timeout=timeout)
+        except queue.Full:
+            self.stop_event.set()
+        self.thread.join(max(deadline - time.monotonic(), 0))
+        if self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join(self.timeout + POLL_INTERVAL)
+        if self.thread.is_alive():
+            # the worker is a daemon thread, it is abandoned with its request
+            logger.warning("analytics sender did not stop, exiting without waiting for it")
+            if self.spool is not None:
+                self.spool.sync(force=True)
+                self.dropped += self.spool.dropped
+            return
+        self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+            self.dropped += self.spool.dropped
+
+    def _abandon(self, batch):
+        # count the batch and the queued events which close gave up on
+        count = len(batch)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(item, _End):
+                count = count + 1
+        self.failed += count
+
+    def _worker(self):
+        batch = []
+        deadline = None
+        while True:
+            if self.stop_event.is_set():
+                self._abandon(batch)
+                return
+            if deadline is None:
+                wait = POLL_INTERVAL
+            else:
+                wait = min(max(deadline - time.monotonic(), 0), POLL_INTERVAL)
+            try:
+                item = self.queue.get(timeout=wait)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, _End):
+                while len(batch) > 0 and not self.stop_event.is_set():
+                    self._post(batch[:self.batch_size])
+                    batch = batch[self.batch_size:]
+                self._abandon(batch)
+                return
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._post(batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+                deadline = time.monotonic() + self.flush_interval if len(batch) > 0 else None
+
+    def _spool_worker(self):
+        first_pending = None
+        failures = 0
+        while not self.stop_event.is_set():
+            self.spool.sync()
+            if self.spool.pending == 0:
+                if self.closing.is_set():
+                    return
+                first_pending = None
+                self.stop_event.wait(POLL_INTERVAL)
+                continue
+            if first_pending is None:
+                first_pending = time.monotonic()
+            if self.spool.pending < self.batch_size and not self.closing.is_set() and \
+                    time.monotonic() - first_pending < self.flush_interval:
+                self.stop_event.wait(POLL_INTERVAL)
+                continue
+
+            events, first_time, cursor, skipped = self.spool.read(self.batch_size, max_span=self.flush_interval)
+            if len(events) == 0:
+                # everything up to the write position was read
+                self.spool.commit(cursor, self.spool.pending)
+                continue
+            result = self._request(events, first_time)
+            if result == SEND_RETRY:
+                if self.closing.is_set() and failures >= self.max_retries:
+                    # left in the spool for the next run
+                    return
+                delay = min(self.backoff * (2 ** failures), self.max_backoff)
+                failures = failures + 1
+                self.stop_event.wait(delay)
+                continue
+            if result == SEND_REJECTED:
+                self.failed += len(events)
+            failures = 0
+            first_pending = None
+            self.spool.commit(cursor, len(events) + skipped)
+
+    def _request(self, events, timestamp_micros=None):
+        payload = {"client_id": self.client_id, "events": events}
+        if timestamp_micros is not None:
+            payload["timestamp_micros"] = timestamp_micros
+        try:
+            r = self.session.post(self.url, data=json.dumps(payload), timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning("analytics send error " + str(e))
+            return SEND_RETRY
+        if 200 <= r.status_code < 300:
+            self.sent += len(events)
+            logger.info("analytics send success " + str(r.status_code) + " (" + str(len(events)) + " events)")
+            return SEND_OK
+        logger.error("analytics send error " + str(r.status_code))
+        if r.status_code < 500 and r.status_code != 429:
+            # the request itself is rejected, retrying does not help
+            return SEND_REJECTED
+        return SEND_RETRY
+
+    def _post(self, events):
+        for attempt in range(self.max_retries + 1):
+            # interrupted when close gives up
+            if attempt > 0:
+                self.stop_event.wait(self.backoff * (2 ** (attempt - 1)))
+            if self.stop_event.is_set():
+                break
+            result = self._request(events)
+            if result == SEND_OK:
+                return True
+            if result == SEND_REJECTED:
+                break
+        self.failed += len(events)
+        return False
@@ -1,8 +1,5 @@
 import sys
 import time
-import uuid
-import requests
-import json
 import datetime
 
 import numpy as np
@@ -15,7 +12,6 @@ import ailia
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser
 from model_utils import check_and_download_models  # noqa: E402
-from image_utils import normalize_image  # noqa: E402C
 from webcamera_utils import get_capture, get_writer  # noqa: E402
 # logger
 from logging import getLogger  # noqa: E402
@@ -23,7 +19,11 @@ from logging import getLogger  # noqa: E402
 # post processing
 logger = getLogger(__name__)
 
-from bytetrack_utils import multiclass_nms
+from bytetrack_utils import LetterboxPreprocessor, batched_nms
+from pipeline_utils import BatchStage, FramePipeline, FrameSink, TaskPool
+from crossing_utils import LineCrossingCounter, TRACKING_STATE_NONE, TRACKING_STATE_DONE
+from crop_utils import CropBuffer
+from analytics_utils import AnalyticsSender, EventSpool, GA_ENDPOINT
 from tracker.byte_tracker import BYTETracker
 
 # ======================
@@ -85,14 +85,37 @@ parser.add_argument(
 )
 parser.add_argument(
     '-c', '--category', default='person',
-    choices=('person', 'vehicle'),
-    help='category type'
+    help='category type (person, vehicle or comma separated COCO class ids)'
+)
+parser.add_argument(
+    '--class_agnostic_nms',
+    action='store_true',
+    help='Merge the classes of the category into one class before NMS.'
+)
+parser.add_argument(
+    '--pre_nms_topk', type=int, default=None,
+    help='Maximum number of candidate boxes passed to NMS.'
 )
 parser.add_argument(
     '--gui',
     action='store_true',
     help='Display preview in GUI.'
 )
+parser.add_argument(
+    '--headless',
+    action='store_true',
+    help='Only count. No preview and no console output, frames are only drawn when they are saved.'
+)
+parser.add_argument(
+    '--crossing_mode', type=str, default='history', choices=('history', 'incremental'),
+    help='history: test the movement over the last 10 frames against the lines every frame. ' +
+    'incremental: only test the movement since the previous frame.'
+)
+parser.add_argument(
+    '--line_grid_size', type=int, default=0,
+    help='Cell size in pixels of a grid index over the crossing lines, so that tracks are only ' +
+    'tested against nearby lines. Useful with many lines. (0: test every line)'
+)
 parser.add_argument(
     '--crossing_line', type=str, default=None,
     help='Set crossing line x1 y1 x2 y2 x3 y3 x4 y4.'
@@ -120,11 +143,30 @@ parser.add_argument(
     action='store_true',
     help='Apply age gender detection.'
 )
+parser.add_argument(
+    '--age_gender_head_ratio', type=float, default=0.0,
+    help='Search faces in this upper part of the person first, and in the whole person only ' +
+    'when nothing is found there. (0: search the whole person)'
+)
 parser.add_argument(
     '--always_classification',
     action='store_true',
     help='Always classification for debug.'
 )
+parser.add_argument(
+    '--best_crops', type=int, default=0,
+    help='Keep the N best crops of each track and classify them once when the track ends, ' +
+    'instead of the crop at the moment of crossing. (0: classify at crossing)'
+)
+parser.add_argument(
+    '--async_classification',
+    action='store_true',
+    help='Run clip and age gender classification on a worker thread, results are applied when they are ready.'
+)
+parser.add_argument(
+    '--classification_queue_size', type=int, default=16,
+    help='Maximum number of frames of crops waiting for asynchronous classification, further crops are dropped.'
+)
 parser.add_argument(
     '--analytics_api_secret', type=str, default=None,
     help='Send analytics data to google analytics.'
@@ -133,10 +175,44 @@ parser.add_argument(
     '--analytics_measurement_id', type=str, default=None,
     help='Send analytics data to google analytics.'
 )
+parser.add_argument(
+    '--analytics_endpoint', type=str, default=GA_ENDPOINT,
+    help='Measurement protocol endpoint the analytics data is sent to.'
+)
+parser.add_argument(
+    '--analytics_flush_interval', type=float, default=1.0,
+    help='Maximum time in seconds an analytics event waits to be sent with others in one request.'
+)
+parser.add_argument(
+    '--analytics_spool_dir', type=str, default=None,
+    help='Store analytics events in this directory until they are sent, so that they survive network outages and restarts.'
+)
+parser.add_argument(
+    '--analytics_spool_max_mb', type=float, default=64,
+    help='Maximum disk usage of the analytics spool in MB, the oldest events are dropped beyond it.'
+)
+parser.add_argument(
+    '--pipeline',
+    action='store_true',
+    help='Run capture, detection and output writing on worker threads.'
+)
+parser.add_argument(
+    '--pipeline_queue_size', type=int, default=4,
+    help='Number of frames buffered between pipeline stages.'
+)
+parser.add_argument(
+    '--batch_size', type=int, default=1,
+    help='Number of frames sent to the detector in one call. (implies --pipeline when greater than 1)'
+)
+parser.add_argument(
+    '--batch_timeout', type=float, default=50,
+    help='Maximum time in milliseconds to wait for a full detection batch.'
+)
 
 # tracking args
 parser.add_argument("--track_thresh", type=float, default=0.5, help="tracking confidence threshold")
 parser.add_argument("--track_buffer", type=int, default=30, help="the frames for keep lost tracks")
+parser.add_argument("--removed_track_buffer", type=int, default=None, help="the frames for keep removed tracks (default: same as track_buffer)")
 parser.add_argument("--match_thresh", type=float, default=0.8, help="matching threshold for tracking")
 parser.add_argument('--min-box-area', type=float, default=10, help='filter out tiny boxes')
 args = update_parser(parser)
@@ -149,7 +225,7 @@ sys.path.append('../clip')
 sys.path.append('../age-gender-retail')
 
 if args.clip:
-    from clip import create_clip, recognize_clip
+    from clip import create_clip, recognize_clip_batch
 if args.age_gender:
     from age_gender_retail import create_age_gender_retail, recognize_age_gender_retail
 
@@ -164,6 +240,96 @@ else:
     clip_text = ["man", "woman"]
 
 
+# ======================
+# Classification
+# ======================
+
+def classify_persons(net_clip, net_age_gender, imgs):
+    results = [{} for _ in imgs]
+    if args.clip:
+        # all crops are encoded together
+        prob = recognize_clip_batch(net_clip, imgs)
+        ids = np.argmax(prob, axis=1)
+        for result, i, p in zip(results, ids, prob):
+            result["clip"] = (i, p[i])
+    if args.age_gender:
+        for result, img in zip(results, imgs):
+            age, gender, face = recognize_age_gender_retail(net_age_gender, img)
+            if age == None:
+                label = "Unknown"
+            else:
+                label = str(age) + " " + str(gender)
+            result["age_gender"] = (label, face)
+    return results
+
+def merge_classifications(results):
+    # most confident clip result, age gender of the best crop where a face was found
+    result = dict(results[0])
+    if "clip" in result:
+        result["clip"] = max((r["clip"] for r in results), key=lambda c: c[1])
+    if "age_gender" in result:
+        for r in results:
+            if r["age_gender"][0] != "Unknown":
+                result["age_gender"] = r["age_gender"]
+                break
+    return result
+
+def classify_crops(net_clip, net_age_gender, crops_list):
+    # crops_list has the crops of each person best first, all crops are classified in one batch
+    imgs = [img for crops in crops_list for img in crops]
+    results = classify_persons(net_clip, net_age_gender, imgs)
+    merged = []
+    p = 0
+    for crops in crops_list:
+        merged.append(merge_classifications(results[p:p + len(crops)]))
+        p = p + len(crops)
+    return merged
+
+def apply_classification(result, tid, counted, clip_id, clip_conf, clip_count, age_gender_id, age_gender_list, alive=True):
+    # counted is the number of times the person was counted
+    label = None
+    face = None
+    if "clip" in result:
+        i, conf = result["clip"]
+        if alive:
+            clip_id[tid] = i
+            clip_conf[tid] = conf
+        clip_count[i] = clip_count[i] + int(counted)
+        label = clip_text[i]
+    if "age_gender" in result:
+        label, face = result["age_gender"]
+        if alive:
+            age_gender_id[tid] = label
+        age_gender_list.extend([label] * int(counted))
+    return label, face
+
+
+# ======================
+# Category
+# ======================
+
+# COCO class ids counted for each category (yolox output columns)
+CATEGORY_CLASS_IDS = {
+    'person': [0],
+    'vehicle': [2, 5, 7], # car, bus, truck
+}
+
+NUM_COCO_CLASSES = 80
+
+def get_class_ids(category):
+    if category in CATEGORY_CLASS_IDS:
+        return np.array(CATEGORY_CLASS_IDS[category])
+    try:
+        ids = np.array([int(c) for c in category.split(",")])
+    except ValueError:
+        return None
+    if np.any(ids < 0) or np.any(ids >= NUM_COCO_CLASSES):
+        return None
+    return ids
+
+class_ids = get_class_ids(args.category)
+
+
 # ======================
 # Terminate
 # ======================
@@ -185,29 +351,11 @@ def set_signal_handler():
 # Analytics
 # ======================
 
+# events are sent in batches by a worker thread, created by recognize_from_video
+analytics_sender = None
+
 def send_analytics(event_id):
-    GA_ENDPOINT = "https://www.google-analytics.com/mp/collect"
-    client_id = str(uuid.uuid4())
-    name = event_id
-    payload = {
-        "client_id": client_id,
-        "events": [
-              {
-                  "name": name,
-                  "params": {
-                      "action": "open"
-                  }
-              }
-        ]
-    }
-    data = json.dumps(payload)
-    url = "%s?api_secret=%s&measurement_id=%s" % (
-        GA_ENDPOINT, args.analytics_api_secret, args.analytics_measurement_id)
-    r = requests.post(url, data=data, verify=True)
-    if r.status_code != 204:
-        logger.error("analytics send error "+str(r.status_code))
-    else:
-        logger.info("analytics send success "+str(r.status_code))
+    analytics_sender.send(event_id, {"action": "open"})
 
 # ======================
 # Secondaty Functions
@@ -241,13 +389,6 @@ vis_colors = get_colors(num_colors)
 
 target_lines = []
 
-def intersect(p1, p2, p3, p4):
-    tc1 = (p1[0] - p2[0]) * (p3[1] - p1[1]) + (p1[1] - p2[1]) * (p1[0] - p3[0])
-    tc2 = (p1[0] - p2[0]) * (p4[1] - p1[1]) + (p1[1] - p2[1]) * (p1[0] - p4[0])
-    td1 = (p3[0] - p4[0]) * (p1[1] - p3[1]) + (p3[1] - p4[1]) * (p3[0] - p1[0])
-    td2 = (p3[0] - p4[0]) * (p2[1] - p3[1]) + (p3[1] - p4[1]) * (p3[0] - p2[0])
-    return tc1*tc2<0 and td1*td2<0
-
 def display_line(frame, line_no):
     line_id = target_lines[line_no]["id"]
     lines = target_lines[line_no]["lines"]
@@ -278,102 +419,70 @@ def display_person(frame, img, person_idx, label):
         cv2.putText(frame, label, (x, frame.shape[0] - s),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255,255,255), thickness=1)
 
-TRACKING_STATE_NONE = 0
-TRACKING_STATE_IN = 1
-TRACKING_STATE_OUT = 2
-TRACKING_STATE_DONE = 3
-
-def line_crossing(frame, online_targets, tracking_object, countup_state, frame_no, fps_time, total_time,
+def line_crossing(frame, source_frame, online_targets, crossing, tracking_object, countup_state, frame_no, fps_time, total_time,
     net_clip, clip_id, clip_conf, clip_count,
-    net_age_gender, age_gender_id, age_gender_list, line_no):
-
-    tracking_position = tracking_object[line_no]["tracking_position"]
-    tracking_state = tracking_object[line_no]["tracking_state"]
-    tracking_guard = tracking_object[line_no]["tracking_guard"]
+    net_age_gender, age_gender_id, age_gender_list, line_no, render=True, pending=None):
 
-    original_frame = frame.copy()
-    person_idx = 0
     count_exists_in_frame = False
 
-    display_line(frame, line_no)
+    if render:
+        display_line(frame, line_no)
 
-    for t in online_targets:
+    # crossing results of this line
+    states = crossing["state"][:, line_no].tolist()
+    countups_in = crossing["countup_in"][:, line_no].tolist()
+    countups_out = crossing["countup_out"][:, line_no].tolist()
+    dark_from = crossing["dark_from"][:, line_no].tolist()
+
+    if render or args.always_classification:
+        targets = range(len(online_targets))
+    else:
+        # only the counted tracks have something to do
+        targets = np.nonzero(crossing["countup_in"][:, line_no] | crossing["countup_out"][:, line_no])[0].tolist()
+
+    for idx in targets:
         # get one person
+        t = online_targets[idx]
         tlwh = t.tlwh
         tid = t.track_id
-        x = int(tlwh[0] + tlwh[2]/2)
-        y = int(tlwh[1] + tlwh[3]/2)
+        x, y = crossing["history"][idx][-1]
         y_top = int(tlwh[1])
-        if not (tid in tracking_position):
-            tracking_position[tid] = []
-            tracking_state[tid] = TRACKING_STATE_NONE
-        tracking_position[tid].append({"x":x,"y":y,"frame_no":frame_no})
-
-        # trim older tacking position
-        trim_tacking_position = []
-        for data in tracking_position[tid]:
-            if frame_no - data["frame_no"] >= 10:
-                continue
-            trim_tacking_position.append(data)
-        tracking_position[tid] = trim_tacking_position
-
-        # get history
-        before = None
-        line_before = None
-        countup_in = False
-        countup_out = False
+        tracking_state = states[idx]
+        countup_in = countups_in[idx]
+        countup_out = countups_out[idx]
+        if countup_in:
+            tracking_object[line_no]["human_count_in"] = tracking_object[line_no]["human_count_in"] + 1
+        if countup_out:
+            tracking_object[line_no]["human_count_out"] = tracking_object[line_no]["human_count_out"] + 1
+
         color = vis_colors[int(tid) % num_colors]
         original_color = color
-        for data in tracking_position[tid]:
-            if before == None:
-                before = data
-                line_before = data
-                continue
-            if tracking_state[tid] == TRACKING_STATE_DONE:
-                color = (0, 0, 0)
-            cv2.line(frame, (before["x"],before["y"]), (data["x"], data["y"]), color, thickness=3)
-            
-            # detect line crossing
-            lines = target_lines[line_no]["lines"]
-            if len(lines) >= 2:
-                if intersect((line_before["x"],line_before["y"]), (data["x"], data["y"]), lines[0], lines[1]):
-                    if tracking_state[tid] == TRACKING_STATE_OUT or tracking_state[tid] == TRACKING_STATE_DONE:
-                        tracking_guard[tid] = frame_no
-                        if tracking_state[tid] != TRACKING_STATE_DONE:
-                            tracking_state[tid] = TRACKING_STATE_DONE
-                            countup_in = True
-                            tracking_object[line_no]["human_count_in"] = tracking_object[line_no]["human_count_in"] + 1
-                    else:
-                        tracking_state[tid] = TRACKING_STATE_IN
-                if intersect((line_before["x"],line_before["y"]), (data["x"], data["y"]), lines[2], lines[3]):
-                    if tracking_state[tid] == TRACKING_STATE_IN or tracking_state[tid] == TRACKING_STATE_DONE:
-                        tracking_guard[tid] = frame_no
-                        if tracking_state[tid] != TRACKING_STATE_DONE:
-                            tracking_state[tid] = TRACKING_STATE_DONE
-                            countup_out = True
-                            tracking_object[line_no]["human_count_out"] = tracking_object[line_no]["human_count_out"] + 1
-                    else:
-                        tracking_state[tid] = TRACKING_STATE_OUT
-            before = data
-
-        # display id
-        text = str(tid)
-        cv2.putText(frame, text, (x, y_top),
-                    cv2.FONT_HERSHEY_SIMPLEX, 1.0, color, thickness=3)
-        y_top = y_top + 20
-        if tid in clip_id:
-            text = clip_text[clip_id[tid]] + " " + str(int(clip_conf[tid]*100)/100)
+        if render:
+            # draw history, segments after the track was counted are black
+            history = crossing["history"][idx]
+            for k in range(1, len(history)):
+                if k - 1 >= dark_from[idx]:
+                    color = (0, 0, 0)
+                cv2.line(frame, history[k - 1], history[k], color, thickness=3)
+
+            # display id
+            text = str(tid)
             cv2.putText(frame, text, (x, y_top),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, original_color, thickness=3)
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, color, thickness=3)
             y_top = y_top + 20
-        if tid in age_gender_id:
-            text = age_gender_id[tid]#clip_id[tid]] + " " + str(int(clip_conf[tid]*100)/100)
-            cv2.putText(frame, text, (x, y_top),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, original_color, thickness=3)
+            if tid in clip_id:
+                text = clip_text[clip_id[tid]] + " " + str(int(clip_conf[tid]*100)/100)
+                cv2.putText(frame, text, (x, y_top),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1.0, original_color, thickness=3)
+                y_top = y_top + 20
+            if tid in age_gender_id:
+                text = age_gender_id[tid]#clip_id[tid]] + " " + str(int(clip_conf[tid]*100)/100)
+                cv2.putText(frame, text, (x, y_top),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1.0, original_color, thickness=3)
 
         # display detected person
         thickness = 0
-        if tracking_state[tid] != TRACKING_STATE_NONE and tracking_state[tid] != TRACKING_STATE_DONE:
+        if tracking_state != TRACKING_STATE_NONE and tracking_state != TRACKING_STATE_DONE:
             thickness = 3
         if countup_in or countup_out:
             count_exists_in_frame = True
@@ -385,41 +494,18 @@ def line_crossing(frame, online_targets, tracking_object, countup_state, frame_n
                 else:
                     event_id = "person_out"
                 send_analytics(event_id)
-        if thickness != 0:
+        if render and thickness != 0:
             cv2.rectangle(frame, (int(tlwh[0]), int(tlwh[1])), (int(tlwh[0]+tlwh[2]), int(tlwh[1]+tlwh[3])), color=color, thickness=thickness)
         
-        # clip classification
-        img = None
-        if (args.clip or args.age_gender) and (countup_in or countup_out or args.always_classification):
-            img = original_frame[int(tlwh[1]):int(tlwh[1]+tlwh[3]), int(tlwh[0]):int(tlwh[0]+tlwh[2]),:]
+        # clip classification, the crops of all lines are classified together by the frame loop
+        if pending is not None and (args.clip or args.age_gender) and (countup_in or countup_out or args.always_classification):
+            img = source_frame[int(tlwh[1]):int(tlwh[1]+tlwh[3]), int(tlwh[0]):int(tlwh[0]+tlwh[2]),:]
             if img.shape[0] > 0 and img.shape[1] > 0:
-                if args.clip:
-                    prob = recognize_clip(net_clip, img)
-                    i = np.argmax(prob[0])
-                    clip_id[tid] = i
-                    clip_conf[tid] = prob[0][i]
-                    if countup_in or countup_out:
-                        clip_count[i] = clip_count[i] + 1
-                    label = clip_text[i]
-                if args.age_gender:
-                    age, gender, face = recognize_age_gender_retail(net_age_gender, img)
-                    if age == None:
-                        label = "Unknown"
-                    else:
-                        label = str(age) + " " + str(gender)
-                    img = face
-                    age_gender_id[tid] = label
-                    if countup_in or countup_out:
-                        age_gender_list.append(age_gender_id[tid])
-                if args.always_classification:
-                    display_person(frame, img, person_idx, label)
-                    person_idx = person_idx + 1
+                pending.append((tid, countup_in or countup_out, [img]))
+
+    if not render:
+        return count_exists_in_frame
 
-        # recovery
-        if tid in tracking_guard:
-            if frame_no - tracking_guard[tid] >= 30:
-                tracking_state[tid] = TRACKING_STATE_NONE
-            
     for count in countup_state:
         t = frame_no - count["frame_no"]
         if t >= 10:
@@ -480,34 +566,29 @@ def write_csv(csv, fps_time, time_stamp, tracking_object, clip_count, total_clip
 # Main functions
 # ======================
 
-def preprocess(img, img_size, normalize=True):
-    h, w = img_size
-    im_h, im_w, _ = img.shape
-
-    r = min(h / im_h, w / im_w)
-    oh, ow = int(im_h * r), int(im_w * r)
+# mot models take ImageNet normalized RGB input, yolox takes raw BGR input
+preprocessors = {
+    True: LetterboxPreprocessor(
+        mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), swap_rb=True),
+    False: LetterboxPreprocessor(),
+}
 
-    resized_img = cv2.resize(
-        img,
-        (ow, oh),
-        interpolation=cv2.INTER_LINEAR,
-    )
 
-    img = np.ones((h, w, 3)) * 114.0
-    img[: oh, : ow] = resized_img
+def preprocess(img, img_size, normalize=True, batch_size=1, index=0):
+    # the returned array is a buffer reused by the next call
+    return preprocessors[normalize](img, img_size, batch_size=batch_size, index=index)
 
-    if normalize:
-        img = img[:, :, ::-1]  # BGR -> RGB
-        img = normalize_image(img, 'ImageNet')
 
-    img = img.transpose((2, 0, 1))
-    img = np.expand_dims(img, axis=0)
-    img = img.astype(np.float32)
+# grid offsets and strides per (height, width, p6), they only depend on the input size
+decode_plans = {}
 
-    return img, r
 
+def get_decode_plan(img_size, p6=False):
+    key = (img_size[0], img_size[1], p6)
+    plan = decode_plans.get(key)
+    if plan is not None:
+        return plan
 
-def postprocess(output, ratio, img_size, p6=False, nms_thre=0.7, score_thre=0.1):
     grids = []
     expanded_strides = []
 
@@ -521,20 +602,43 @@ def postprocess(output, ratio, img_size, p6=False, nms_thre=0.7, score_thre=0.1)
 
     for hsize, wsize, stride in zip(hsizes, wsizes, strides):
         xv, yv = np.meshgrid(np.arange(wsize), np.arange(hsize))
-        grid = np.stack((xv, yv), 2).reshape(1, -1, 2)
+        grid = np.stack((xv, yv), 2).reshape(-1, 2)
         grids.append(grid)
-        shape = grid.shape[:2]
-        expanded_strides.append(np.full((*shape, 1), stride))
+        expanded_strides.append(np.full((grid.shape[0], 1), stride))
+
+    plan = (np.concatenate(grids, 0), np.concatenate(expanded_strides, 0))
+    decode_plans[key] = plan
+    return plan
+
 
-    grids = np.concatenate(grids, 1)
-    expanded_strides = np.concatenate(expanded_strides, 1)
-    output[..., :2] = (output[..., :2] + grids) * expanded_strides
-    output[..., 2:4] = np.exp(output[..., 2:4]) * expanded_strides
+def postprocess(output, ratio, img_size, p6=False, nms_thre=0.7, score_thre=0.1,
+                class_ids=None, class_agnostic=False):
+    grids, expanded_strides = get_decode_plan(img_size, p6)
 
     predictions = output[0]
 
-    boxes = predictions[:, :4]
-    scores = predictions[:, 4:5] * predictions[:, 5:]
+    # gather only the class columns of the category
+    if class_ids is None:
+        cls_scores = predictions[:, 5:]
+    else:
+        cls_scores = predictions[:, 5 + class_ids]
+
+    # score every anchor first and decode boxes only for the ones above the threshold
+    scores = predictions[:, 4:5] * cls_scores
+    if class_agnostic:
+        scores = scores.max(axis=1, keepdims=True)
+    valid = np.flatnonzero((scores > score_thre).any(axis=1))
+    if len(valid) == 0:
+        return np.zeros((0, 5))
+
+    predictions = predictions[valid]
+    scores = scores[valid]
+    grids = grids[valid]
+    expanded_strides = expanded_strides[valid]
+
+    boxes = np.empty((len(valid), 4), dtype=predictions.dtype)
+    boxes[:, :2] = (predictions[:, :2] + grids) * expanded_strides
+    boxes[:, 2:4] = np.exp(predictions[:, 2:4]) * expanded_strides
 
     boxes_xyxy = np.ones_like(boxes)
     boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.
@@ -543,12 +647,13 @@ def postprocess(output, ratio, img_size, p6=False, nms_thre=0.7, score_thre=0.1)
     boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.
     boxes_xyxy /= ratio
 
-    dets = multiclass_nms(boxes_xyxy, scores, nms_thr=nms_thre, score_thr=score_thre)
+    dets = batched_nms(
+        boxes_xyxy, scores, nms_thr=nms_thre, score_thr=score_thre, pre_nms_topk=args.pre_nms_topk)
 
     return dets[:, :-1] if dets is not None else np.zeros((0, 5))
 
 
-def predict(net, img):
+def get_img_size():
     dic_model = {
         'mot17_x': (IMAGE_MOT17_X_HEIGHT, IMAGE_MOT17_X_WIDTH),
         'mot17_s': (IMAGE_MOT17_S_HEIGHT, IMAGE_MOT17_S_WIDTH),
@@ -557,8 +662,12 @@ def predict(net, img):
         'yolox_s': (IMAGE_YOLOX_S_HEIGHT, IMAGE_YOLOX_S_WIDTH),
         'yolox_tiny': (IMAGE_YOLOX_TINY_HEIGHT, IMAGE_YOLOX_TINY_WIDTH),
     }
+    return dic_model[args.model_type]
+
+
+def predict(net, img):
     model_type = args.model_type
-    img_size = dic_model[model_type]
+    img_size = get_img_size()
 
     img, ratio = preprocess(img, img_size, normalize=model_type.startswith('mot'))
 
@@ -566,17 +675,38 @@ def predict(net, img):
     output = net.predict([img])
     output = output[0]
 
-    # For yolox, retrieve only the person class
-    if args.category == "vehicle":
-        for c in range(80):
-            if c != 2 and c != 5 and c != 7:
-                output[..., 5 + c] = 0
-    else:
-        output = output[..., :6] # person
+    return decode_output(output, ratio, img_size)
+
+
+def predict_batch(net, imgs):
+    # run several frames (from one or more streams) through a single [N,3,H,W] call
+    model_type = args.model_type
+    img_size = get_img_size()
 
+    ratios = []
+    for i, img in enumerate(imgs):
+        batch, ratio = preprocess(
+            img, img_size, normalize=model_type.startswith('mot'), batch_size=len(imgs), index=i)
+        ratios.append(ratio)
+
+    if tuple(net.get_input_shape()) != batch.shape:
+        net.set_input_shape(batch.shape)
+
+    # feedforward
+    output = net.predict([batch])
+    output = output[0]
+
+    dets = []
+    for i in range(len(imgs)):
+        dets.append(decode_output(output[i:i + 1], ratios[i], img_size))
+    return dets
+
+
+def decode_output(output, ratio, img_size):
     score_thre = args.score_thre
     nms_thre = args.nms_thre
-    dets = postprocess(output, ratio, img_size, nms_thre=nms_thre, score_thre=score_thre)
+    dets = postprocess(output, ratio, img_size, nms_thre=nms_thre, score_thre=score_thre,
+                       class_ids=class_ids, class_agnostic=args.class_agnostic_nms)
 
     return dets
 
@@ -602,7 +732,7 @@ def recognize_from_video(net, net_clip, net_age_gender):
     tracker = BYTETracker(
         track_thresh=args.track_thresh, track_buffer=args.track_buffer,
         match_thresh=args.match_thresh, frame_rate=30,
-        mot20=mot20)
+        mot20=mot20, removed_track_buffer=args.removed_track_buffer)
 
     global target_lines
     if not args.crossing_line:
@@ -635,14 +765,12 @@ def recognize_from_video(net, net_clip, net_age_gender):
     for line_no in range(len(target_lines)):
         obj = {}
         obj["tracking_id"] = target_lines[line_no]["id"]
-        obj["tracking_position"] = {}
-        obj["tracking_state"] = {}
-        obj["tracking_guard"] = {}
         obj["human_count_in"] = 0
         obj["human_count_out"] = 0
         obj["total_count_in"] = 0
         obj["total_count_out"] = 0
         tracking_object.append(obj)
+    line_counter = LineCrossingCounter(target_lines, mode=args.crossing_mode, grid_size=args.line_grid_size)
 
     if args.csvpath != None:
         csv = open_csv(tracking_object)
@@ -653,6 +781,7 @@ def recognize_from_video(net, net_clip, net_age_gender):
 
     frame_shown = False
     before_fps_time = -1
+    before_stats_time = -1
 
     clip_id = {}
     clip_conf = {}
@@ -666,58 +795,184 @@ def recognize_from_video(net, net_clip, net_age_gender):
     age_gender_id = {}
     age_gender_list = []
 
-    while True:
-        ret, frame = capture.read()
-        if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
-            break
-        if frame_shown and cv2.getWindowProperty('frame', cv2.WND_PROP_VISIBLE) == 0:
-            break
-        global terminate_signal
-        if terminate_signal:
-            break
+    if args.async_classification and (args.clip or args.age_gender):
+        # one worker, the networks are shared
+        classifier = TaskPool(lambda crops_list: (classify_crops(net_clip, net_age_gender, crops_list), crops_list),
+            queue_size=args.classification_queue_size)
+    else:
+        classifier = None
 
+    global analytics_sender
+    if args.analytics_api_secret and args.analytics_measurement_id:
+        if args.analytics_spool_dir:
+            spool = EventSpool(args.analytics_spool_dir, max_bytes=int(args.analytics_spool_max_mb * 1024 * 1024))
+        else:
+            spool = None
+        analytics_sender = AnalyticsSender(
+            args.analytics_api_secret, args.analytics_measurement_id,
+            endpoint=args.analytics_endpoint, flush_interval=args.analytics_flush_interval, spool=spool)
+
+    if args.best_crops > 0 and (args.clip or args.age_gender):
+        crop_buffer = CropBuffer(top_k=args.best_crops)
+    else:
+        crop_buffer = None
+
+    def apply_classifications(frame, render, finished):
+        person_idx = 0
+        for keys, results, crops_list in finished:
+            for (tid, counted), result, crops in zip(keys, results, crops_list):
+                img = crops[0]
+                label, face = apply_classification(result, tid, counted,
+                    clip_id, clip_conf, clip_count, age_gender_id, age_gender_list, alive=tid in line_counter.rows)
+                if face is not None:
+                    img = face
+                if render and args.always_classification:
+                    display_person(frame, img, person_idx, label)
+                    person_idx = person_idx + 1
+
+    def read_frame():
+        ret, frame = capture.read()
+        if not ret:
+            return None
         # timestamp
         time_stamp = str(datetime.datetime.now())
+        return frame, time_stamp
 
+    def detect_frame(item):
+        frame, time_stamp = item
         # inference
         output = predict(net, frame)
+        return frame, time_stamp, output
+
+    def detect_frames(items):
+        # inference
+        outputs = predict_batch(net, [frame for frame, _ in items])
+        return [(frame, time_stamp, output) for (frame, time_stamp), output in zip(items, outputs)]
+
+    def write_frame(res_img, path):
+        if writer is not None:
+            writer.write(res_img.astype(np.uint8))
+        if path is not None:
+            cv2.imwrite(path, res_img)
+
+    # capture and detection run ahead of tracking, encoding runs behind it
+    if args.pipeline or args.batch_size > 1:
+        if args.batch_size > 1:
+            detect_stage = BatchStage(detect_frames, args.batch_size, timeout=args.batch_timeout / 1000)
+        else:
+            detect_stage = detect_frame
+        queue_size = max(args.pipeline_queue_size, args.batch_size)
+        pipeline = FramePipeline(read_frame, [detect_stage], queue_size=queue_size).start()
+        sink = FrameSink(write_frame, queue_size=args.pipeline_queue_size)
+    else:
+        pipeline = None
+        sink = None
+
+    while True:
+        if pipeline is not None:
+            item = pipeline.get()
+        else:
+            item = read_frame()
+        if item is None:
+            break
+        if not args.headless:
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+            if frame_shown and cv2.getWindowProperty('frame', cv2.WND_PROP_VISIBLE) == 0:
+                break
+        global terminate_signal
+        if terminate_signal:
+            break
+
+        if pipeline is None:
+            item = detect_frame(item)
+        frame, time_stamp, output = item
 
         # run tracking
         online_targets = tracker.update(output)
-        online_tlwhs = []
-        online_ids = []
-        online_scores = []
-        for t in online_targets:
-            tlwh = t.tlwh
-            tid = t.track_id
-            vertical = tlwh[2] / tlwh[3] > 1.6
-            if tlwh[2] * tlwh[3] > min_box_area and not vertical:
-                online_tlwhs.append(tlwh)
-                online_ids.append(tid)
-                online_scores.append(t.score)
+
+        # forget everything about tracks which the tracker has removed
+        line_counter.remove(tracker.removed_track_ids)
+        for tid in tracker.removed_track_ids:
+            clip_id.pop(tid, None)
+            clip_conf.pop(tid, None)
+            age_gender_id.pop(tid, None)
+        countup_state[:] = [count for count in countup_state if frame_no - count["frame_no"] < 10]
+
+        pending = []  # (tid, counted, crops) to classify
+        if crop_buffer is not None:
+            # the tracks have ended, classify their best crops
+            for tid in tracker.removed_track_ids:
+                counted, crops = crop_buffer.pop(tid)
+                if len(crops) > 0 and (counted > 0 or args.always_classification):
+                    pending.append((tid, counted, crops))
+            crop_buffer.update(frame, [t.track_id for t in online_targets], [t.tlwh for t in online_targets])
 
         # count line crossing
         fps_time = int(frame_no / fps)
         total_time = int(frames / fps)
+        if before_stats_time != fps_time:
+            logger.debug("tracker stats " + str(tracker.stats()))
+            before_stats_time = fps_time
         count_exists_in_frame = False
+        centers = []
+        for t in online_targets:
+            tlwh = t.tlwh
+            centers.append((int(tlwh[0] + tlwh[2]/2), int(tlwh[1] + tlwh[3]/2)))
+        crossing = line_counter.update([t.track_id for t in online_targets], centers, frame_no)
+
+        # in headless mode, only draw frames which are saved
+        render = not args.headless or writer is not None or (args.imgpath and (
+            crossing["countup_in"].any() or crossing["countup_out"].any()))
+        # crops for classification are taken before anything is drawn
+        if render and (args.clip or args.age_gender):
+            source_frame = frame.copy()
+        else:
+            source_frame = frame
+
         for line_no in range(len(target_lines)):
-            cur_count_exists_in_frame = line_crossing(frame, online_targets, tracking_object, countup_state, frame_no, fps_time, total_time,
+            cur_count_exists_in_frame = line_crossing(frame, source_frame, online_targets, crossing, tracking_object, countup_state, frame_no, fps_time, total_time,
                 net_clip, clip_id, clip_conf, clip_count,
-                net_age_gender, age_gender_id, age_gender_list, line_no)
+                net_age_gender, age_gender_id, age_gender_list, line_no, render=render,
+                pending=pending if crop_buffer is None else None)
             if cur_count_exists_in_frame:
                 count_exists_in_frame = True
+        if crop_buffer is not None:
+            counts = crossing["countup_in"].sum(axis=1) + crossing["countup_out"].sum(axis=1)
+            for idx in np.nonzero(counts)[0]:
+                crop_buffer.count(online_targets[idx].track_id, int(counts[idx]))
+
+        # classification of the crops of this frame in one batch
+        finished = []
+        if len(pending) > 0:
+            keys = [(tid, counted) for tid, counted, _ in pending]
+            crops_list = [crops for _, _, crops in pending]
+            if classifier is not None:
+                # the results are applied when they are ready
+                classifier.submit(keys, [[img.copy() for img in crops] for crops in crops_list])
+            else:
+                finished.append((keys, classify_crops(net_clip, net_age_gender, crops_list), crops_list))
+        if classifier is not None:
+            finished.extend((keys, results, crops_list) for keys, (results, crops_list) in classifier.poll())
+        apply_classifications(frame, render, finished)
         res_img = frame
 
         # show
-        if args.gui or args.video:
+        if args.headless:
+            pass
+        elif args.gui or args.video:
             cv2.imshow('frame', res_img)
             frame_shown = True
         else:
+            online_ids = []
+            for t in online_targets:
+                tlwh = t.tlwh
+                vertical = tlwh[2] / tlwh[3] > 1.6
+                if tlwh[2] * tlwh[3] > min_box_area and not vertical:
+                    online_ids.append(t.track_id)
             print("Online ids",online_ids)
 
         # save results
-        if writer is not None:
-            writer.write(res_img.astype(np.uint8))
         if csv is not None:
             if before_fps_time != fps_time:
                 write_csv(csv, fps_time, time_stamp, tracking_object, clip_count, total_clip_count, age_gender_list)
@@ -732,6 +987,7 @@ def recognize_from_video(net, net_clip, net_age_gender):
                         total_clip_count[i] = clip_count[i]
 
         # save frame
+        path = None
         if count_exists_in_frame:
             if args.imgpath:
                 path = time_stamp
@@ -739,12 +995,50 @@ def recognize_from_video(net, net_clip, net_age_gender):
                 path = path.replace(".","-")
                 path = path.replace(":","-")
                 path = args.imgpath+"/"+path+".jpg"
-                cv2.imwrite(path, res_img)
+        if writer is not None or path is not None:
+            if sink is not None:
+                sink.put(res_img, path)
+            else:
+                write_frame(res_img, path)
 
         frame_no = frame_no + 1
 
+    if pipeline is not None:
+        pipeline.stop()
+    if sink is not None:
+        sink.close()
+    if classifier is not None:
+        classifier.close()
+        apply_classifications(None, False, [(keys, results, crops_list) for keys, (results, crops_list) in classifier.poll()])
+        if classifier.dropped > 0:
+            logger.warning(str(classifier.dropped) + " frames of crops were not classified because the queue was full.")
+    if crop_buffer is not None:
+        # tracks which are still alive at the end of the stream
+        pending = []
+        for tid in crop_buffer.track_ids():
+            counted, crops = crop_buffer.pop(tid)
+            if len(crops) > 0 and (counted > 0 or args.always_classification):
+                pending.append((tid, counted, crops))
+        if len(pending) > 0:
+            keys = [(tid, counted) for tid, counted, _ in pending]
+            crops_list = [crops for _, _, crops in pending]
+            apply_classifications(None, False, [(keys, classify_crops(net_clip, net_age_gender, crops_list), crops_list)])
+    if csv is not None and frame_no > 0:
+        # the counts and the classifications which finished after the last row,
+        # including those of the tracks which were alive at the end
+        changed = len(age_gender_list) > 0 or clip_count != total_clip_count or any(
+            obj["human_count_in"] != obj["total_count_in"] or obj["human_count_out"] != obj["total_count_out"]
+            for obj in tracking_object)
+        if changed:
+            write_csv(csv, int(np.ceil(frame_no / fps)), time_stamp, tracking_object, clip_count, total_clip_count, age_gender_list)
+    if analytics_sender is not None:
+        analytics_sender.close()
+        if analytics_sender.dropped > 0 or analytics_sender.failed > 0:
+            logger.warning("analytics events not sent : " + str(analytics_sender.dropped) + " dropped, " +
+                str(analytics_sender.failed) + " failed")
     capture.release()
-    cv2.destroyAllWindows()
+    if not args.headless:
+        cv2.destroyAllWindows()
     if writer is not None:
         writer.release()
     if csv is not None:
@@ -770,7 +1064,10 @@ def main():
     model_type = args.model_type
     weight_path, model_path = dic_model[model_type]
 
-    if args.category != "person" and not ("yolo" in model_type):
+    if class_ids is None:
+        logger.error("Unknown category "+args.category+".")
+        return
+    if list(class_ids) != CATEGORY_CLASS_IDS["person"] and not ("yolo" in model_type):
         logger.error("Category "+args.category+" only supports on yolo model.")
         return
 
@@ -791,7 +1088,7 @@ def main():
         net_clip = None
 
     if args.age_gender:
-        net_age_gender = create_age_gender_retail(args.env_id)
+        net_age_gender = create_age_gender_retail(args.env_id, head_ratio=args.age_gender_head_ratio)
     else:
         net_age_gender = None
 
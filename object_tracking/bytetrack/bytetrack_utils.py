@@ -2,12 +2,81 @@ import numpy as np
 import cv2
 
 __all__ = [
+    'LetterboxPreprocessor',
+    'batched_nms',
     'multiclass_nms',
 ]
 
 
-def nms(boxes, scores, nms_thr):
-    """Single class NMS implemented in Numpy."""
+class LetterboxPreprocessor(object):
+    """Letterbox preprocessing into reusable float32 input buffers.
+
+    The frame is resized into the top-left region of a preallocated
+    (N, 3, h, w) buffer. Channel swap, mean/std normalization and the
+    HWC -> CHW layout change are done in a single float32 pass per channel,
+    and only the padding strips are refilled, so no full size temporary
+    array is allocated per frame.
+
+    The returned buffer is owned by the preprocessor and is overwritten by
+    the next call with the same size.
+    """
+
+    def __init__(self, mean=None, std=None, swap_rb=False, pad_value=114.0):
+        if mean is None:
+            scale = np.ones(3)
+            bias = np.zeros(3)
+        else:
+            # (x / 255 - mean) / std == x * scale + bias
+            scale = 1.0 / (255.0 * np.asarray(std, dtype=np.float64))
+            bias = -np.asarray(mean, dtype=np.float64) / np.asarray(std, dtype=np.float64)
+        self.swap_rb = swap_rb
+        self.scale = scale.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.pad = (pad_value * scale + bias).astype(np.float32)
+        self.buffers = {}
+
+    def get_buffer(self, img_size, batch_size=1):
+        key = (batch_size, img_size[0], img_size[1])
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = np.empty((batch_size, 3, img_size[0], img_size[1]), dtype=np.float32)
+            self.buffers[key] = buf
+        return buf
+
+    def __call__(self, img, img_size, batch_size=1, index=0):
+        """Preprocess `img` into slot `index` of the buffer and return (buffer, ratio)."""
+        h, w = img_size
+        im_h, im_w, _ = img.shape
+
+        r = min(h / im_h, w / im_w)
+        oh, ow = int(im_h * r), int(im_w * r)
+
+        resized_img = cv2.resize(
+            img,
+            (ow, oh),
+            interpolation=cv2.INTER_LINEAR,
+        )
+
+        buf = self.get_buffer(img_size, batch_size)
+        for c in range(3):
+            src = 2 - c if self.swap_rb else c
+            dst = buf[index, c]
+            dst[oh:, :] = self.pad[c]
+            dst[:oh, ow:] = self.pad[c]
+            dst = dst[:oh, :ow]
+            np.multiply(resized_img[:, :, src], self.scale[c], out=dst, casting='unsafe')
+            if self.bias[c] != 0:
+                dst += self.bias[c]
+
+        return buf, r
+
+
+def nms(boxes, scores, nms_thr, classes=None):
+    """Single class NMS implemented in Numpy.
+
+    If `classes` is given, a box only suppresses boxes with the same class,
+    so that several classes are handled in one pass.
+    """
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
     x2 = boxes[:, 2]
@@ -30,7 +99,10 @@ def nms(boxes, scores, nms_thr):
         inter = w * h
         ovr = inter / (areas[i] + areas[order[1:]] - inter)
 
-        inds = np.where(ovr <= nms_thr)[0]
+        if classes is None:
+            inds = np.where(ovr <= nms_thr)[0]
+        else:
+            inds = np.where((ovr <= nms_thr) | (classes[order[1:]] != classes[i]))[0]
         order = order[inds + 1]
 
     return keep
@@ -60,3 +132,50 @@ def multiclass_nms(boxes, scores, nms_thr, score_thr):
         return None
 
     return np.concatenate(final_dets, 0)
+
+
+def batched_nms(boxes, scores, nms_thr, score_thr, class_ids=None, pre_nms_topk=None):
+    """Multiclass NMS over all classes in a single pass.
+
+    Only the score columns listed in `class_ids` are looked at, and boxes of
+    different classes never suppress each other. The result has the same
+    layout and order (by class, then by score) as `multiclass_nms`.
+    `pre_nms_topk` caps the number of candidates passed to NMS.
+    """
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids)
+        scores = scores[:, class_ids]
+
+    # candidates in class major order, like the per class loop
+    cls_inds, box_inds = np.nonzero(scores.T > score_thr)
+    if len(box_inds) == 0:
+        return None
+
+    if pre_nms_topk is not None and len(box_inds) > pre_nms_topk:
+        top = np.sort(np.argpartition(-scores[box_inds, cls_inds], pre_nms_topk - 1)[:pre_nms_topk])
+        cls_inds = cls_inds[top]
+        box_inds = box_inds[top]
+
+    valid_scores = scores[box_inds, cls_inds]
+    valid_boxes = boxes[box_inds]
+
+    if hasattr(cv2.dnn, 'NMSBoxesBatched'):
+        # OpenCV separates the classes with coordinate offsets. Widths and
+        # heights are given +1 to match the pixel convention of `nms`.
+        rects = np.empty((len(valid_boxes), 4), dtype=np.float64)
+        rects[:, :2] = valid_boxes[:, :2]
+        rects[:, 2:] = valid_boxes[:, 2:] - valid_boxes[:, :2] + 1
+        keep = cv2.dnn.NMSBoxesBatched(
+            rects, valid_scores.astype(np.float64), cls_inds.astype(np.int32), score_thr, nms_thr)
+        keep = np.asarray(keep, dtype=int).reshape(-1)
+    else:
+        keep = np.asarray(nms(valid_boxes, valid_scores, nms_thr, classes=cls_inds), dtype=int)
+    keep = keep[np.lexsort((-valid_scores[keep], cls_inds[keep]))]
+
+    labels = cls_inds[keep]
+    if class_ids is not None:
+        labels = class_ids[labels]
+    dets = np.concatenate(
+        [valid_boxes[keep], valid_scores[keep, None], labels[:, None].astype(np.float64)], 1
+    )
+    return dets
@@ -0,0 +1,97 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'CropBuffer',
+    'geometry_score',
+    'sharpness',
+]
+
+# width / height of a standing person
+PERSON_ASPECT = 0.41
+# square root of the area from which a crop is large enough for the classifiers
+FULL_SIZE = 224
+# sharpness is measured on a gray copy downscaled to this height
+SHARPNESS_HEIGHT = 64
+# laplacian variance at which a crop scores half sharp
+SHARPNESS_REF = 100.0
+
+
+def geometry_score(tlwh, frame_w, frame_h):
+    """Score in [0, 1] of a box from its size, its aspect ratio and how much of it is inside the frame."""
+    x, y, w, h = tlwh
+    if w <= 0 or h <= 0:
+        return 0.0
+    vis_w = min(x + w, frame_w) - max(x, 0)
+    vis_h = min(y + h, frame_h) - max(y, 0)
+    if vis_w <= 0 or vis_h <= 0:
+        return 0.0
+    visible = (vis_w * vis_h) / (w * h)
+    size = min(1.0, np.sqrt(vis_w * vis_h) / FULL_SIZE)
+    aspect = w / h
+    aspect = min(aspect / PERSON_ASPECT, PERSON_ASPECT / aspect)
+    return size * aspect * visible
+
+
+def sharpness(img):
+    """Score in [0, 1] from the variance of the laplacian, low for blurred crops."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if gray.shape[0] > SHARPNESS_HEIGHT:
+        w = max(1, gray.shape[1] * SHARPNESS_HEIGHT // gray.shape[0])
+        gray = cv2.resize(gray, (w, SHARPNESS_HEIGHT), interpolation=cv2.INTER_AREA)
+    var = cv2.Laplacian(gray, cv2.CV_32F).var()
+    return var / (var + SHARPNESS_REF)
+
+
+class CropBuffer(object):
+    """Best crops of each live track, for classification when the track ends.
+
+    Each track keeps its `top_k` crops with the highest score, best first.
+    The score is `geometry_score * sharpness`. Since the sharpness is at
+    most 1, the crop is only cut out and measured when its geometry score
+    can beat the worst kept crop. `count` records how many times the track
+    was counted, and `pop` hands both over when the track is finalized.
+    """
+
+    def __init__(self, top_k=1):
+        self.top_k = top_k
+        self.crops = {}  # tid -> [(score, crop)], best first
+        self.counted = {}  # tid -> number of countings
+
+    def __len__(self):
+        return len(self.crops)
+
+    def track_ids(self):
+        return list(self.crops.keys())
+
+    def update(self, frame, track_ids, tlwhs):
+        frame_h, frame_w = frame.shape[:2]
+        for tid, tlwh in zip(track_ids, tlwhs):
+            crops = self.crops.setdefault(tid, [])
+            score = geometry_score(tlwh, frame_w, frame_h)
+            if score <= 0 or (len(crops) >= self.top_k and score <= crops[-1][0]):
+                continue
+            x0 = max(int(tlwh[0]), 0)
+            y0 = max(int(tlwh[1]), 0)
+            x1 = min(int(tlwh[0] + tlwh[2]), frame_w)
+            y1 = min(int(tlwh[1] + tlwh[3]), frame_h)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            img = frame[y0:y1, x0:x1, :]
+            score = score * sharpness(img)
+            if len(crops) >= self.top_k and score <= crops[-1][0]:
+                continue
+            i = len(crops)
+            while i > 0 and crops[i - 1][0] < score:
+                i = i - 1
+            # the frame is drawn on later, so keep a copy
+            crops.insert(i, (score, img.copy()))
+            del crops[self.top_k:]
+
+    def count(self, tid, n=1):
+        self.counted[tid] = self.counted.get(tid, 0) + n
+
+    def pop(self, tid):
+        """Remove a track and return (number of countings, crops best first)."""
+        crops = self.crops.pop(tid, [])
+        return self.counted.pop(tid, 0), [img for _, img in crops]
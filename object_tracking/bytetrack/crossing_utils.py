@@ -0,0 +1,385 @@
+import numpy as np
+
+__all__ = [
+    'TRACKING_STATE_NONE',
+    'TRACKING_STATE_IN',
+    'TRACKING_STATE_OUT',
+    'TRACKING_STATE_DONE',
+    'LineCrossingCounter',
+    'LineGrid',
+    'segments_intersect',
+    'side_of_line',
+]
+
+TRACKING_STATE_NONE = 0
+TRACKING_STATE_IN = 1
+TRACKING_STATE_OUT = 2
+TRACKING_STATE_DONE = 3
+
+# guard value of tracks which have not crossed a line yet
+NO_GUARD = -1
+
+
+def side_of_line(p, a, b):
+    """Signed side of point p relative to the line through a and b.
+
+    The points are arrays whose last axis is (x, y) and are broadcast
+    against each other. Zero means that p is on the line.
+    """
+    return (a[..., 0] - b[..., 0]) * (p[..., 1] - a[..., 1]) + (a[..., 1] - b[..., 1]) * (a[..., 0] - p[..., 0])
+
+
+def segments_intersect(p1, p2, p3, p4):
+    """Whether segment p1-p2 properly crosses segment p3-p4, for broadcast arrays of points."""
+    tc1 = side_of_line(p3, p1, p2)
+    tc2 = side_of_line(p4, p1, p2)
+    td1 = side_of_line(p1, p3, p4)
+    td2 = side_of_line(p2, p3, p4)
+    return (tc1 * tc2 < 0) & (td1 * td2 < 0)
+
+
+class LineGrid(object):
+    """Uniform grid index over the bounding boxes of the counting lines.
+
+    Every line is registered in the cells covered by the bounding box of its
+    IN and OUT segments. `candidates` returns the (box, line) pairs whose
+    cells overlap, so that a movement is only tested against the lines near
+    it. The pairs are a superset of the pairs that can cross.
+    """
+
+    def __init__(self, lines, cell_size):
+        lines = np.asarray(lines, dtype=np.int64)
+        lo = lines.min(axis=1)
+        hi = lines.max(axis=1)
+        self.num_lines = len(lines)
+        self.cell_size = cell_size
+        self.origin = lo.min(axis=0)
+        self.end = hi.max(axis=0)
+        self.shape = (self.end - self.origin) // cell_size + 1  # cells in x, y
+
+        cells = []
+        for c0, c1 in zip((lo - self.origin) // cell_size, (hi - self.origin) // cell_size):
+            xs, ys = np.meshgrid(np.arange(c0[0], c1[0] + 1), np.arange(c0[1], c1[1] + 1))
+            cells.append((ys * self.shape[0] + xs).ravel())
+        line_ids = np.repeat(np.arange(len(cells)), [len(c) for c in cells])
+        cells = np.concatenate(cells)
+        order = np.argsort(cells, kind='stable')
+
+        # lines of cell c are line_ids[cell_start[c]:cell_start[c + 1]]
+        self.line_ids = line_ids[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def candidates(self, lo, hi):
+        """(box index, line index) pairs of the boxes lo-hi (Nx2 each) and the lines in their cells."""
+        inside = (hi >= self.origin).all(axis=1) & (lo <= self.end).all(axis=1)
+        c0 = np.clip((lo - self.origin) // self.cell_size, 0, self.shape - 1)
+        c1 = np.clip((hi - self.origin) // self.cell_size, 0, self.shape - 1)
+        nx = c1[:, 0] - c0[:, 0] + 1
+        counts = np.where(inside, nx * (c1[:, 1] - c0[:, 1] + 1), 0)
+
+        # all cells of every box
+        boxes = np.repeat(np.arange(len(lo)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (c0[boxes, 1] + k // nx[boxes]) * self.shape[0] + c0[boxes, 0] + k % nx[boxes]
+
+        # all lines of every cell
+        counts = self.cell_start[cells + 1] - self.cell_start[cells]
+        boxes = np.repeat(boxes, counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        lines = self.line_ids[np.repeat(self.cell_start[cells], counts) + k]
+
+        pairs = np.unique(boxes * self.num_lines + lines)
+        return pairs // self.num_lines, pairs % self.num_lines
+
+
+class LineCrossingCounter(object):
+    """Line crossing state of every track against every counting line.
+
+    Each line of `target_lines` has an IN segment (points 0 and 1) and an
+    OUT segment (points 2 and 3). A track which crosses the OUT segment and
+    then the IN segment is counted as "in", the opposite order as "out".
+    The segments from the oldest position of the last `history_frames`
+    frames to each later position are tested, and a track which counted is
+    reset `guard_frames` frames after its last crossing.
+
+    With `mode="incremental"` only the newest segment, from the previous
+    position to the current one, is tested. The side of each line on which
+    every track was last seen is kept, and the segment is only tested where
+    it has changed. Only the lines whose bounding box the newest segment
+    overlaps are tested, and a position exactly on a line keeps the side it
+    came from while the track stays in that box. Once the guard of a line
+    has passed, a track which entered the IN or OUT state is reset after
+    `history_frames` frames, so that as in the history mode a track is only
+    counted again when it crosses both segments within that many frames.
+
+    All tracks and lines are processed together in `update`, the per track
+    state is kept in (tracks, lines) arrays. The position history of each
+    track is a ring buffer of `history_frames` entries in a preallocated
+    array, shared by all lines. With `grid_size`, a `LineGrid` with cells of
+    that many pixels selects the lines tested against each track.
+    """
+
+    def __init__(self, target_lines, history_frames=10, guard_frames=30, mode="history", grid_size=None, capacity=64):
+        if mode not in ("history", "incremental"):
+            raise ValueError("unknown crossing mode " + str(mode))
+        self.mode = mode
+        lines = np.array([line["lines"][:4] for line in target_lines], dtype=np.int64).reshape(-1, 4, 2)
+        self.in_lines = lines[:, 0:2]
+        self.out_lines = lines[:, 2:4]
+        self.line_lo = lines.min(axis=1)
+        self.line_hi = lines.max(axis=1)
+        self.grid = None
+        if grid_size and len(lines) > 0:
+            self.grid = LineGrid(lines, grid_size)
+        self.history_frames = history_frames
+        self.guard_frames = guard_frames
+
+        self.rows = {}  # track_id -> row of the arrays below
+        self.free = []  # rows of removed tracks
+        self.state = np.full((capacity, len(lines)), TRACKING_STATE_NONE, dtype=int)
+        self.guard = np.full((capacity, len(lines)), NO_GUARD, dtype=np.int64)
+        # sign of side_of_line of the last position, for the incremental mode
+        self.side_in = np.zeros((capacity, len(lines)), dtype=np.int8)
+        self.side_out = np.zeros((capacity, len(lines)), dtype=np.int8)
+        # frame in which the sides were stored, they are only kept while tested
+        self.side_frame = np.full((capacity, len(lines)), -1, dtype=np.int64)
+        # frame in which the IN or OUT state was entered, for the incremental mode
+        self.state_frame = np.zeros((capacity, len(lines)), dtype=np.int64)
+
+        # position history, entry (start + i) % history_frames is the i-th oldest
+        self.positions = np.zeros((capacity, history_frames, 2), dtype=np.int64)
+        self.frames = np.zeros((capacity, history_frames), dtype=np.int64)
+        self.start = np.zeros(capacity, dtype=int)
+        self.length = np.zeros(capacity, dtype=int)
+
+    def _grow(self):
+        def double(a, fill):
+            return np.concatenate([a, np.full_like(a, fill)])
+
+        self.state = double(self.state, TRACKING_STATE_NONE)
+        self.guard = double(self.guard, NO_GUARD)
+        self.side_in = double(self.side_in, 0)
+        self.side_out = double(self.side_out, 0)
+        self.side_frame = double(self.side_frame, -1)
+        self.state_frame = double(self.state_frame, 0)
+        self.positions = double(self.positions, 0)
+        self.frames = double(self.frames, 0)
+        self.start = double(self.start, 0)
+        self.length = double(self.length, 0)
+
+    def _allocate(self, track_id):
+        if len(self.free) > 0:
+            row = self.free.pop()
+        else:
+            row = len(self.rows)
+            if row == len(self.state):
+                self._grow()
+        self.rows[track_id] = row
+        return row
+
+    def remove(self, track_ids):
+        """Forget the state of tracks which the tracker has removed."""
+        for track_id in track_ids:
+            row = self.rows.pop(track_id, None)
+            if row is None:
+                continue
+            self.state[row] = TRACKING_STATE_NONE
+            self.guard[row] = NO_GUARD
+            self.side_in[row] = 0
+            self.side_out[row] = 0
+            self.side_frame[row] = -1
+            self.state_frame[row] = 0
+            self.start[row] = 0
+            self.length[row] = 0
+            self.free.append(row)
+
+    def update(self, track_ids, centers, frame_no):
+        """Add the centers of the tracks of this frame and test them against all lines.
+
+        Returns a dict of (tracks, lines) arrays:
+          countup_in, countup_out: the track was counted on the line in this frame
+          state: the state after the crossing test, before the guard reset
+          dark_from: index of the first history segment tested while the
+            track was already counted on the line (number of segments if none)
+        and `history`, the positions of each track from the oldest as lists
+        of [x, y]. In the incremental mode dark_from is 0 for tracks which
+        were already counted before this frame.
+        """
+        rows = np.empty(len(track_ids), dtype=int)
+        for i, track_id in enumerate(track_ids):
+            row = self.rows.get(track_id)
+            if row is None:
+                row = self._allocate(track_id)
+            rows[i] = row
+
+        # drop positions older than history_frames and append the new one
+        size = self.history_frames
+        order = (self.start[rows, None] + np.arange(size)) % size
+        frames = self.frames[rows[:, None], order]
+        old = (np.arange(size) < self.length[rows, None]) & (frame_no - frames >= size)
+        dropped = old.sum(1)
+        start = (self.start[rows] + dropped) % size
+        lengths = self.length[rows] - dropped
+        end = (start + lengths) % size
+        self.positions[rows, end] = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+        self.frames[rows, end] = frame_no
+        lengths += 1
+        self.start[rows] = start
+        self.length[rows] = lengths
+
+        num_tracks = len(rows)
+        num_lines = len(self.in_lines)
+        num_segments = max(lengths.max() - 1, 0) if num_tracks > 0 else 0
+
+        order = (start[:, None] + np.arange(num_segments + 1)) % size
+        points = self.positions[rows[:, None], order]
+
+        state = self.state[rows]
+        guard = self.guard[rows]
+        countup_in = np.zeros((num_tracks, num_lines), dtype=bool)
+        countup_out = np.zeros((num_tracks, num_lines), dtype=bool)
+
+        if self.mode == "incremental":
+            before = state.copy()
+            dark_from = self._test_newest(rows, points, lengths, state, guard, countup_in, countup_out, frame_no)
+            entered = (state != before) & ((state == TRACKING_STATE_IN) | (state == TRACKING_STATE_OUT))
+            state_frame = self.state_frame[rows]
+            state_frame[entered] = frame_no
+            self.state_frame[rows] = state_frame
+        else:
+            dark_from = self._test_history(points, lengths, state, guard, countup_in, countup_out, frame_no)
+
+        result_state = state.copy()
+
+        # recovery
+        recovered = (guard != NO_GUARD) & (frame_no - guard >= self.guard_frames)
+        if self.mode == "incremental":
+            # the history mode rebuilds the state from the last history_frames
+            # frames, here a half crossing is kept for as long
+            recovered &= (state == TRACKING_STATE_DONE) | (frame_no - self.state_frame[rows] >= self.history_frames)
+        state[recovered] = TRACKING_STATE_NONE
+        self.state[rows] = state
+        self.guard[rows] = guard
+
+        return {
+            "countup_in": countup_in,
+            "countup_out": countup_out,
+            "state": result_state,
+            "dark_from": dark_from,
+            "history": [p[:n] for p, n in zip(points.tolist(), lengths.tolist())],
+        }
+
+    def _candidates(self, points, lengths):
+        """(track index, line index) pairs to test."""
+        if self.grid is None:
+            tracks, lines = np.indices((len(points), len(self.in_lines)))
+            return tracks.ravel(), lines.ravel()
+
+        # bounding box of the history of each track
+        valid = (np.arange(points.shape[1]) < lengths[:, None])[:, :, None]
+        lo = np.where(valid, points, np.iinfo(np.int64).max).min(axis=1)
+        hi = np.where(valid, points, np.iinfo(np.int64).min).max(axis=1)
+        return self.grid.candidates(lo, hi)
+
+    def _test_history(self, points, lengths, state, guard, countup_in, countup_out, frame_no):
+        """Test the segments from the oldest position to every later one."""
+        num_segments = points.shape[1] - 1
+        valid = np.arange(num_segments)[None, :] < (lengths - 1)[:, None]
+
+        # pairs which are not tested keep their state for the whole history
+        moved = (lengths >= 2)[:, None]
+        dark_from = np.where((state == TRACKING_STATE_DONE) & moved, 0, num_segments)
+
+        tracks, lines = self._candidates(points, lengths)
+        start = points[tracks, None, 0]
+        end = points[tracks, 1:]
+        hit_in = segments_intersect(start, end, self.in_lines[lines, None, 0], self.in_lines[lines, None, 1])
+        hit_out = segments_intersect(start, end, self.out_lines[lines, None, 0], self.out_lines[lines, None, 1])
+        valid = valid[tracks]
+        hit_in &= valid
+        hit_out &= valid
+
+        pair_state = state[tracks, lines]
+        pair_guard = guard[tracks, lines]
+        pair_countup_in = np.zeros(len(tracks), dtype=bool)
+        pair_countup_out = np.zeros(len(tracks), dtype=bool)
+        pair_dark_from = np.full(len(tracks), num_segments, dtype=int)
+
+        # step the state machine through the history, all pairs at once
+        for k in range(num_segments):
+            done = (pair_state == TRACKING_STATE_DONE) & valid[:, k]
+            pair_dark_from[done & (pair_dark_from == num_segments)] = k
+            self._step(hit_in[:, k], hit_out[:, k], pair_state, pair_guard,
+                       pair_countup_in, pair_countup_out, frame_no)
+
+        state[tracks, lines] = pair_state
+        guard[tracks, lines] = pair_guard
+        countup_in[tracks, lines] = pair_countup_in
+        countup_out[tracks, lines] = pair_countup_out
+        dark_from[tracks, lines] = pair_dark_from
+        return dark_from
+
+    def _test_newest(self, rows, points, lengths, state, guard, countup_in, countup_out, frame_no):
+        """Test the segment from the previous position to the current one."""
+        index = np.arange(len(rows))
+        current = points[index, lengths - 1]
+        previous = points[index, np.maximum(lengths - 2, 0)]
+        moved = lengths >= 2
+        previous_frame = self.frames[rows, (self.start[rows] + np.maximum(lengths - 2, 0)) % self.history_frames]
+
+        lo = np.minimum(previous, current)
+        hi = np.maximum(previous, current)
+        if self.grid is None:
+            tracks, line_ids = np.indices((len(rows), len(self.in_lines)))
+            tracks, line_ids = tracks.ravel(), line_ids.ravel()
+        else:
+            tracks, line_ids = self.grid.candidates(lo, hi)
+        # the grid returns a superset, keep the pairs whose boxes overlap so
+        # that the result does not depend on the cell size
+        near = (hi[tracks] >= self.line_lo[line_ids]).all(axis=1) & (lo[tracks] <= self.line_hi[line_ids]).all(axis=1)
+        tracks = tracks[near]
+        line_ids = line_ids[near]
+        track_rows = rows[tracks]
+        kept = self.side_frame[track_rows, line_ids] == previous_frame[tracks]
+
+        hits = []
+        for lines, sides in ((self.in_lines, self.side_in), (self.out_lines, self.side_out)):
+            a = lines[line_ids, 0]
+            b = lines[line_ids, 1]
+            side = np.sign(side_of_line(current[tracks], a, b)).astype(np.int8)
+            # the stored side is only used when the previous position is on the
+            # line, and only if it was stored for that position
+            last_side = np.sign(side_of_line(previous[tracks], a, b)).astype(np.int8)
+            last_side = np.where(last_side != 0, last_side, np.where(kept, sides[track_rows, line_ids], 0))
+            # where the track has changed sides, check that it passed between the end points
+            changed = np.nonzero(moved[tracks] & (last_side * side < 0))[0]
+            hit = np.zeros((len(rows), len(lines)), dtype=bool)
+            p = previous[tracks[changed]]
+            q = current[tracks[changed]]
+            hit[tracks[changed], line_ids[changed]] = side_of_line(a[changed], p, q) * side_of_line(b[changed], p, q) < 0
+            # a position exactly on the line keeps the side it came from
+            sides[track_rows, line_ids] = np.where(side != 0, side, last_side)
+            hits.append(hit)
+        self.side_frame[track_rows, line_ids] = frame_no
+
+        num_segments = points.shape[1] - 1
+        dark_from = np.where(state == TRACKING_STATE_DONE, 0, num_segments)
+        self._step(hits[0], hits[1], state, guard, countup_in, countup_out, frame_no)
+        return dark_from
+
+    @staticmethod
+    def _step(hit_in, hit_out, state, guard, countup_in, countup_out, frame_no):
+        """Advance the IN/OUT state machine by one tested segment."""
+        armed = hit_in & ((state == TRACKING_STATE_OUT) | (state == TRACKING_STATE_DONE))
+        guard[armed] = frame_no
+        counted = armed & (state != TRACKING_STATE_DONE)
+        countup_in |= counted
+        state[counted] = TRACKING_STATE_DONE
+        state[hit_in & ~armed] = TRACKING_STATE_IN
+
+        armed = hit_out & ((state == TRACKING_STATE_IN) | (state == TRACKING_STATE_DONE))
+        guard[armed] = frame_no
+        counted = armed & (state != TRACKING_STATE_DONE)
+        countup_out |= counted
+        state[counted] = TRACKING_STATE_DONE
+        state[hit_out & ~armed] = TRACKING_STATE_OUT
@@ -0,0 +1,278 @@
+import queue
+import threading
+import time
+
+__all__ = [
+    'BatchStage',
+    'FramePipeline',
+    'FrameSink',
+    'TaskPool',
+]
+
+# polling interval used so that blocked workers notice stop requests
+POLL_INTERVAL = 0.1
+
+
+def _put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            return True, q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return False, None
+
+
+class _End(object):
+    """Marker passed down the queues when the source is exhausted."""
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+class BatchStage(object):
+    """Pipeline stage which processes several items per call.
+
+    `func` receives a list of up to `batch_size` items and returns a list of
+    the same length. Once the first item of a batch has arrived, the stage
+    waits at most `timeout` seconds for the rest, so that live sources are
+    not delayed until a full batch has been captured.
+    """
+
+    def __init__(self, func, batch_size, timeout=None):
+        self.func = func
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+
+class FramePipeline(object):
+    """Staged frame pipeline running each stage on its own worker thread.
+
+    `source` is called repeatedly and returns the next item, or None at the
+    end of the stream. Each callable in `stages` maps an item to the next
+    item, or is a `BatchStage`. Stages are single threaded and connected by
+    bounded FIFO queues, so items come out of `get()` in the order the
+    source produced them.
+    """
+
+    def __init__(self, source, stages, queue_size=4):
+        self.source = source
+        self.stages = stages
+        self.stop_event = threading.Event()
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.threads = [threading.Thread(target=self._source_worker, daemon=True)]
+        for i, stage in enumerate(stages):
+            if isinstance(stage, BatchStage):
+                target = self._batch_stage_worker
+            else:
+                target = self._stage_worker
+            self.threads.append(threading.Thread(
+                target=target, args=(stage, self.queues[i], self.queues[i + 1]), daemon=True))
+        self.finished = False
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _source_worker(self):
+        end = _End()
+        try:
+            while not self.stop_event.is_set():
+                item = self.source()
+                if item is None:
+                    break
+                if not _put(self.queues[0], item, self.stop_event):
+                    return
+        except Exception as e:
+            end = _End(e)
+        _put(self.queues[0], end, self.stop_event)
+
+    def _stage_worker(self, stage, in_queue, out_queue):
+        while True:
+            ok, item = _get(in_queue, self.stop_event)
+            if not ok:
+                return
+            if not isinstance(item, _End):
+                try:
+                    item = stage(item)
+                except Exception as e:
+                    item = _End(e)
+            if not _put(out_queue, item, self.stop_event):
+                return
+            if isinstance(item, _End):
+                return
+
+    def _collect_batch(self, stage, in_queue):
+        ok, item = _get(in_queue, self.stop_event)
+        if not ok:
+            return None, None
+        if isinstance(item, _End):
+            return [], item
+        batch = [item]
+        deadline = None
+        if stage.timeout is not None:
+            deadline = time.monotonic() + stage.timeout
+        while len(batch) < stage.batch_size and not self.stop_event.is_set():
+            if deadline is None:
+                wait = POLL_INTERVAL
+            else:
+                wait = min(deadline - time.monotonic(), POLL_INTERVAL)
+                if wait <= 0:
+                    break
+            try:
+                item = in_queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if isinstance(item, _End):
+                return batch, item
+            batch.append(item)
+        return batch, None
+
+    def _batch_stage_worker(self, stage, in_queue, out_queue):
+        while True:
+            batch, end = self._collect_batch(stage, in_queue)
+            if batch is None:
+                return
+            items = []
+            if len(batch) > 0:
+                try:
+                    items = stage.func(batch)
+                except Exception as e:
+                    end = _End(e)
+            if end is None or end.error is None:
+                for item in items:
+                    if not _put(out_queue, item, self.stop_event):
+                        return
+            if end is not None:
+                _put(out_queue, end, self.stop_event)
+                return
+
+    def get(self):
+        """Return the next processed item, or None at the end of the stream."""
+        if self.finished:
+            return None
+        ok, item = _get(self.queues[-1], self.stop_event)
+        if not ok:
+            return None
+        if isinstance(item, _End):
+            self.finished = True
+            if item.error is not None:
+                raise item.error
+            return None
+        return item
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+
+class FrameSink(object):
+    """Run `write` on a worker thread so that encoding overlaps the frame loop.
+
+    Arguments given to `put()` are handed to `write` in the same order.
+    The queue is bounded, so a slow sink applies backpressure instead of
+    buffering frames without limit.
+    """
+
+    def __init__(self, write, queue_size=4):
+        self.write = write
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, _End):
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+
+    def put(self, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(args)
+
+    def close(self):
+        self.queue.put(_End())
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class TaskPool(object):
+    """Run `func` on worker threads without ever blocking the caller.
+
+    `submit(key, *args)` queues a call of `func(*args)`. When the bounded
+    queue is full the task is dropped and False is returned. Finished tasks
+    are collected with `poll()` as (key, result) pairs in completion order.
+    """
+
+    def __init__(self, func, num_workers=1, queue_size=16):
+        self.func = func
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.error = None
+        self.dropped = 0
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.tasks.get()
+            if isinstance(item, _End):
+                return
+            if self.error is not None:
+                continue
+            key, args = item
+            try:
+                self.results.put((key, self.func(*args)))
+            except Exception as e:
+                self.error = e
+
+    def submit(self, key, *args):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.tasks.put_nowait((key, args))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def poll(self):
+        """Return the results finished since the last call."""
+        if self.error is not None:
+            raise self.error
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """Wait for the queued tasks to finish, their results stay available to `poll()`."""
+        for _ in self.threads:
+            self.tasks.put(_End())
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
@@ -9,9 +9,21 @@ class TrackState(object):
     Removed = 3
 
 
+class TrackIdAllocator(object):
+    """Sequential track ids starting from 1, one sequence per tracker."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return self.count
+
+
 class BaseTrack(object):
     _count = 0
 
+    id_allocator = None
     track_id = 0
     is_activated = False
     state = TrackState.New
@@ -31,8 +43,10 @@ class BaseTrack(object):
     def end_frame(self):
         return self.frame_id
 
-    @staticmethod
-    def next_id():
+    def next_id(self):
+        if self.id_allocator is not None:
+            return self.id_allocator()
+        # process wide sequence for tracks which do not belong to a tracker
         BaseTrack._count += 1
         return BaseTrack._count
 
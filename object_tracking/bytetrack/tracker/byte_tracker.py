@@ -1,23 +1,68 @@
+from collections import deque
+
 import numpy as np
 
 from .kalman_filter import KalmanFilter
-from .basetrack import BaseTrack, TrackState
+from .basetrack import BaseTrack, TrackIdAllocator, TrackState
+from .track_store import TrackStore
 from . import matching
 
 
 class STrack(BaseTrack):
-    shared_kalman = KalmanFilter()
-
     def __init__(self, tlwh, score):
         # wait activate
         self._tlwh = np.asarray(tlwh, dtype=np.float)
         self.kalman_filter = None
+        self.store, self.slot = None, None
         self.mean, self.covariance = None, None
         self.is_activated = False
 
         self.score = score
         self.tracklet_len = 0
 
+    @property
+    def mean(self):
+        if self.slot is None:
+            return self._mean
+        return self.store.mean[self.slot]
+
+    @mean.setter
+    def mean(self, mean):
+        if self.slot is None:
+            self._mean = mean
+        else:
+            self.store.mean[self.slot] = mean
+
+    @property
+    def covariance(self):
+        if self.slot is None:
+            return self._covariance
+        return self.store.covariance[self.slot]
+
+    @covariance.setter
+    def covariance(self, covariance):
+        if self.slot is None:
+            self._covariance = covariance
+        else:
+            self.store.covariance[self.slot] = covariance
+
+    def attach(self, store):
+        """Move the Kalman state into a row of `store`."""
+        mean, covariance = self.mean, self.covariance
+        self.store = store
+        self.slot = store.allocate(self)
+        if mean is not None:
+            self.mean, self.covariance = mean, covariance
+
+    def detach(self):
+        """Copy the Kalman state out of the store and give the row back."""
+        if self.slot is None:
+            return
+        mean, covariance = self.mean.copy(), self.covariance.copy()
+        self.store.release(self.slot)
+        self.store, self.slot = None, None
+        self.mean, self.covariance = mean, covariance
+
     def predict(self):
         mean_state = self.mean.copy()
         if self.state != TrackState.Tracked:
@@ -25,22 +70,28 @@ class STrack(BaseTrack):
         self.mean, self.covariance = self.kalman_filter.predict(mean_state, self.covariance)
 
     @staticmethod
-    def multi_predict(stracks):
+    def multi_predict(stracks, kalman_filter=None):
         if len(stracks) > 0:
+            if kalman_filter is None:
+                kalman_filter = stracks[0].kalman_filter
             multi_mean = np.asarray([st.mean.copy() for st in stracks])
             multi_covariance = np.asarray([st.covariance for st in stracks])
             for i, st in enumerate(stracks):
                 if st.state != TrackState.Tracked:
                     multi_mean[i][7] = 0
-            multi_mean, multi_covariance = STrack.shared_kalman.multi_predict(multi_mean, multi_covariance)
+            multi_mean, multi_covariance = kalman_filter.multi_predict(multi_mean, multi_covariance)
             for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, store=None, id_allocator=None):
         """Start a new tracklet"""
         self.kalman_filter = kalman_filter
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
         self.track_id = self.next_id()
+        if store is not None:
+            self.attach(store)
         self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
 
         self.tracklet_len = 0
@@ -82,6 +133,20 @@ class STrack(BaseTrack):
 
         self.score = new_track.score
 
+    def mark_updated(self, score, frame_id, refind=False):
+        """
+        Update everything but the Kalman state of a matched track, the
+        state itself is corrected in a batch by the tracker.
+        """
+        self.frame_id = frame_id
+        if refind:
+            self.tracklet_len = 0
+        else:
+            self.tracklet_len += 1
+        self.state = TrackState.Tracked
+        self.is_activated = True
+        self.score = score
+
     @property
     def tlwh(self):
         """Get current position in bounding box format `(top left x, top left y,
@@ -136,10 +201,12 @@ class BYTETracker(object):
     def __init__(
             self, track_thresh=0.6, track_buffer=30,
             match_thresh=0.9, frame_rate=30,
-            mot20=False):
+            mot20=False, removed_track_buffer=None):
         self.tracked_stracks = []  # type: list[STrack]
         self.lost_stracks = []  # type: list[STrack]
-        self.removed_stracks = []  # type: list[STrack]
+        # removed tracks are only kept for removed_buffer frames
+        self.removed_stracks = deque()  # type: deque[STrack]
+        self.removed_ids = {}  # track_id -> frame the track was removed
 
         self.frame_id = 0
         self.track_thresh = track_thresh
@@ -147,8 +214,65 @@ class BYTETracker(object):
         self.det_thresh = track_thresh + 0.1
         self.buffer_size = int(frame_rate / 30.0 * track_buffer)
         self.max_time_lost = self.buffer_size
+        if removed_track_buffer is None:
+            self.removed_buffer = self.buffer_size
+        else:
+            self.removed_buffer = int(frame_rate / 30.0 * removed_track_buffer)
         self.mot20 = mot20
+        # every tracker has its own Kalman filter and track id sequence, so
+        # that several trackers can run in one process independently
         self.kalman_filter = KalmanFilter()
+        self.id_allocator = TrackIdAllocator()
+        # Kalman state of every tracked and lost track
+        self.store = TrackStore()
+        # ids of the tracks dropped for good in the last update
+        self.removed_track_ids = []
+
+    def add_removed(self, stracks):
+        for track in stracks:
+            if track.track_id not in self.removed_ids:
+                self.removed_ids[track.track_id] = self.frame_id
+                self.removed_stracks.append(track)
+
+        # forget tracks which were removed more than removed_buffer frames ago
+        while len(self.removed_stracks) > 0:
+            track_id = self.removed_stracks[0].track_id
+            if self.frame_id - self.removed_ids[track_id] <= self.removed_buffer:
+                break
+            self.removed_stracks.popleft()
+            del self.removed_ids[track_id]
+
+    def stats(self):
+        """Number of tracks held by the tracker, to check that it stays bounded."""
+        return {
+            'frame_id': self.frame_id,
+            'tracked': len(self.tracked_stracks),
+            'lost': len(self.lost_stracks),
+            'removed': len(self.removed_stracks),
+            'store_size': len(self.store),
+            'store_capacity': self.store.capacity,
+        }
+
+    def tlbr(self, stracks):
+        slots = np.array([track.slot for track in stracks], dtype=int)
+        return self.store.tlbr(slots)
+
+    def multi_predict(self, stracks):
+        if len(stracks) == 0:
+            return
+        slots = np.array([track.slot for track in stracks], dtype=int)
+        multi_mean = self.store.mean[slots]
+        not_tracked = np.array([track.state != TrackState.Tracked for track in stracks])
+        multi_mean[not_tracked, 7] = 0
+        self.store.mean[slots], self.store.covariance[slots] = self.kalman_filter.multi_predict(
+            multi_mean, self.store.covariance[slots])
+
+    def multi_update(self, stracks, measurements):
+        if len(stracks) == 0:
+            return
+        slots = np.array([track.slot for track in stracks], dtype=int)
+        self.store.mean[slots], self.store.covariance[slots] = self.kalman_filter.multi_update(
+            self.store.mean[slots], self.store.covariance[slots], np.asarray(measurements))
 
     def update(self, output_results):
         self.frame_id += 1
@@ -157,6 +281,10 @@ class BYTETracker(object):
         lost_stracks = []
         removed_stracks = []
 
+        # matched tracks and their measurements, corrected together
+        updated_stracks = []
+        measurements = []
+
         if output_results.shape[1] == 5:
             scores = output_results[:, 4]
             bboxes = output_results[:, :4]
@@ -174,13 +302,10 @@ class BYTETracker(object):
         scores_keep = scores[remain_inds]
         scores_second = scores[inds_second]
 
-        if len(dets) > 0:
-            '''Detections'''
-            detections = [
-                STrack(STrack.tlbr_to_tlwh(tlbr), s) for (tlbr, s) in zip(dets, scores_keep)
-            ]
-        else:
-            detections = []
+        '''Detections'''
+        tlwhs_keep = tlbrs_to_tlwhs(dets)
+        tlbrs_keep = tlwhs_to_tlbrs(tlwhs_keep)
+        xyahs_keep = tlwhs_to_xyahs(tlwhs_keep)
 
         ''' Add newly detected tracklets to tracked_stracks'''
         unconfirmed = []
@@ -194,43 +319,41 @@ class BYTETracker(object):
         ''' Step 2: First association, with high score detection boxes'''
         strack_pool = joint_stracks(tracked_stracks, self.lost_stracks)
         # Predict the current location with KF
-        STrack.multi_predict(strack_pool)
-        dists = matching.iou_distance(strack_pool, detections)
+        self.multi_predict(strack_pool)
+        dists = matching.iou_distance(self.tlbr(strack_pool), tlbrs_keep)
         if not self.mot20:
-            dists = matching.fuse_score(dists, detections)
+            dists = matching.fuse_score(dists, scores_keep)
 
         matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.match_thresh)
 
         for itracked, idet in matches:
             track = strack_pool[itracked]
-            det = detections[idet]
             if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
+                track.mark_updated(scores_keep[idet], self.frame_id)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.mark_updated(scores_keep[idet], self.frame_id, refind=True)
                 refind_stracks.append(track)
+            updated_stracks.append(track)
+            measurements.append(xyahs_keep[idet])
 
         ''' Step 3: Second association, with low score detection boxes'''
         # association the untrack to the low score detections
-        if len(dets_second) > 0:
-            '''Detections'''
-            detections_second = [STrack(STrack.tlbr_to_tlwh(tlbr), s) for
-                                 (tlbr, s) in zip(dets_second, scores_second)]
-        else:
-            detections_second = []
+        tlwhs_second = tlbrs_to_tlwhs(dets_second)
+        xyahs_second = tlwhs_to_xyahs(tlwhs_second)
         r_tracked_stracks = [strack_pool[i] for i in u_track if strack_pool[i].state == TrackState.Tracked]
-        dists = matching.iou_distance(r_tracked_stracks, detections_second)
+        dists = matching.iou_distance(self.tlbr(r_tracked_stracks), tlwhs_to_tlbrs(tlwhs_second))
         matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)
         for itracked, idet in matches:
             track = r_tracked_stracks[itracked]
-            det = detections_second[idet]
             if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
+                track.mark_updated(scores_second[idet], self.frame_id)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.mark_updated(scores_second[idet], self.frame_id, refind=True)
                 refind_stracks.append(track)
+            updated_stracks.append(track)
+            measurements.append(xyahs_second[idet])
 
         for it in u_track:
             track = r_tracked_stracks[it]
@@ -239,27 +362,33 @@ class BYTETracker(object):
                 lost_stracks.append(track)
 
         '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
-        detections = [detections[i] for i in u_detection]
-        dists = matching.iou_distance(unconfirmed, detections)
+        u_detection = np.asarray(u_detection, dtype=int)
+        dists = matching.iou_distance(self.tlbr(unconfirmed), tlbrs_keep[u_detection])
         if not self.mot20:
-            dists = matching.fuse_score(dists, detections)
+            dists = matching.fuse_score(dists, scores_keep[u_detection])
 
-        matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)
+        matches, u_unconfirmed, u_detection_unconfirmed = matching.linear_assignment(dists, thresh=0.7)
 
         for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
-            activated_starcks.append(unconfirmed[itracked])
+            track = unconfirmed[itracked]
+            track.mark_updated(scores_keep[u_detection[idet]], self.frame_id)
+            activated_starcks.append(track)
+            updated_stracks.append(track)
+            measurements.append(xyahs_keep[u_detection[idet]])
         for it in u_unconfirmed:
             track = unconfirmed[it]
             track.mark_removed()
             removed_stracks.append(track)
 
+        # correct all matched tracks in one call
+        self.multi_update(updated_stracks, measurements)
+
         """ Step 4: Init new stracks"""
-        for inew in u_detection:
-            track = detections[inew]
-            if track.score < self.det_thresh:
+        for inew in u_detection[np.asarray(u_detection_unconfirmed, dtype=int)]:
+            if scores_keep[inew] < self.det_thresh:
                 continue
-            track.activate(self.kalman_filter, self.frame_id)
+            track = STrack(tlwhs_keep[inew], scores_keep[inew])
+            track.activate(self.kalman_filter, self.frame_id, store=self.store, id_allocator=self.id_allocator)
             activated_starcks.append(track)
         """ Step 5: Update state"""
         for track in self.lost_stracks:
@@ -274,9 +403,20 @@ class BYTETracker(object):
         self.tracked_stracks = joint_stracks(self.tracked_stracks, refind_stracks)
         self.lost_stracks = sub_stracks(self.lost_stracks, self.tracked_stracks)
         self.lost_stracks.extend(lost_stracks)
-        self.lost_stracks = sub_stracks(self.lost_stracks, self.removed_stracks)
-        self.removed_stracks.extend(removed_stracks)
-        self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(self.tracked_stracks, self.lost_stracks)
+        self.lost_stracks = [t for t in self.lost_stracks if t.track_id not in self.removed_ids]
+        self.add_removed(removed_stracks)
+        self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(
+            self.tracked_stracks, self.lost_stracks, self.tlbr)
+
+        # give the store rows of tracks which are no longer tracked or lost
+        # back, such tracks can not be matched any more
+        alive = set(t.track_id for t in self.tracked_stracks)
+        alive.update(t.track_id for t in self.lost_stracks)
+        self.removed_track_ids = []
+        for track in list(self.store.tracks.values()):
+            if track.track_id not in alive:
+                track.detach()
+                self.removed_track_ids.append(track.track_id)
 
         # get scores of lost tracks
         output_stracks = [track for track in self.tracked_stracks if track.is_activated]
@@ -284,6 +424,25 @@ class BYTETracker(object):
         return output_stracks
 
 
+def tlbrs_to_tlwhs(tlbrs):
+    ret = np.asarray(tlbrs, dtype=np.float64).reshape(-1, 4).copy()
+    ret[:, 2:] -= ret[:, :2]
+    return ret
+
+
+def tlwhs_to_tlbrs(tlwhs):
+    ret = tlwhs.copy()
+    ret[:, 2:] += ret[:, :2]
+    return ret
+
+
+def tlwhs_to_xyahs(tlwhs):
+    ret = tlwhs.copy()
+    ret[:, :2] += ret[:, 2:] / 2
+    ret[:, 2] /= ret[:, 3]
+    return ret
+
+
 def joint_stracks(tlista, tlistb):
     exists = {}
     res = []
@@ -309,8 +468,11 @@ def sub_stracks(tlista, tlistb):
     return list(stracks.values())
 
 
-def remove_duplicate_stracks(stracksa, stracksb):
-    pdist = matching.iou_distance(stracksa, stracksb)
+def remove_duplicate_stracks(stracksa, stracksb, tlbr=None):
+    if tlbr is not None:
+        pdist = matching.iou_distance(tlbr(stracksa), tlbr(stracksb))
+    else:
+        pdist = matching.iou_distance(stracksa, stracksb)
     pairs = np.where(pdist < 0.15)
     dupa, dupb = list(), list()
     for p, q in zip(*pairs):
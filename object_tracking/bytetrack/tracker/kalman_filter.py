@@ -178,10 +178,9 @@ class KalmanFilter(object):
             self._std_weight_velocity * mean[:, 3]]
         sqr = np.square(np.r_[std_pos, std_vel]).T
 
-        motion_cov = []
-        for i in range(len(mean)):
-            motion_cov.append(np.diag(sqr[i]))
-        motion_cov = np.asarray(motion_cov)
+        motion_cov = np.zeros((len(mean), 8, 8))
+        diag = np.arange(8)
+        motion_cov[:, diag, diag] = sqr
 
         mean = np.dot(mean, self._motion_mat.T)
         left = np.dot(self._motion_mat, covariance).transpose((1, 0, 2))
@@ -189,6 +188,69 @@ class KalmanFilter(object):
 
         return mean, covariance
 
+    def multi_project(self, mean, covariance):
+        """Project state distribution to measurement space (Vectorized version).
+
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrics of the object states.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected mean and Nx4x4 covariance matrics of
+            the given state estimates.
+
+        """
+        std = np.stack([
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_position * mean[:, 3],
+            1e-1 * np.ones_like(mean[:, 3]),
+            self._std_weight_position * mean[:, 3]], axis=1)
+        diag = np.arange(4)
+        innovation_cov = np.zeros((len(mean), 4, 4))
+        innovation_cov[:, diag, diag] = np.square(std)
+
+        mean = np.dot(mean, self._update_mat.T)
+        covariance = np.matmul(np.matmul(self._update_mat, covariance), self._update_mat.T)
+        return mean, covariance + innovation_cov
+
+    def multi_update(self, mean, covariance, measurement):
+        """Run Kalman filter correction step (Vectorized version).
+
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrics of the object states.
+        measurement : ndarray
+            The Nx4 dimensional measurement matrix (x, y, a, h), where (x, y)
+            is the center position, a the aspect ratio, and h the height of
+            the bounding box.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+
+        # solve S K^T = (P H^T)^T for every track at once
+        kalman_gain = np.linalg.solve(
+            projected_cov, np.matmul(covariance, self._update_mat.T).transpose((0, 2, 1))
+        ).transpose((0, 2, 1))
+        innovation = measurement - projected_mean
+
+        new_mean = mean + np.matmul(kalman_gain, innovation[:, :, None])[:, :, 0]
+        new_covariance = covariance - np.matmul(
+            np.matmul(kalman_gain, projected_cov), kalman_gain.transpose((0, 2, 1)))
+        return new_mean, new_covariance
+
     def update(self, mean, covariance, measurement):
         """Run Kalman filter correction step.
 
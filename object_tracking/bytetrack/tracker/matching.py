@@ -140,10 +140,16 @@ def iou_distance(atracks, btracks):
 
 
 def fuse_score(cost_matrix, detections):
+    """
+    :type detections: list[STrack] | np.ndarray of detection scores
+    """
     if cost_matrix.size == 0:
         return cost_matrix
     iou_sim = 1 - cost_matrix
-    det_scores = np.array([det.score for det in detections])
+    if isinstance(detections, np.ndarray):
+        det_scores = detections
+    else:
+        det_scores = np.array([det.score for det in detections])
     det_scores = np.expand_dims(det_scores, axis=0).repeat(cost_matrix.shape[0], axis=0)
     fuse_sim = iou_sim * det_scores
     fuse_cost = 1 - fuse_sim
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class TrackStore(object):
+    """
+    Kalman filter state of the live tracks of one tracker, kept in
+    contiguous arrays so that predict and update can run on all tracks at
+    once.
+
+    Row `slot` of `mean` (Nx8) and `covariance` (Nx8x8) belongs to the track
+    which was given that slot by `allocate`. Freed slots are reused and the
+    arrays grow by doubling when they are full.
+
+    """
+
+    def __init__(self, capacity=64):
+        self.mean = np.zeros((capacity, 8))
+        self.covariance = np.zeros((capacity, 8, 8))
+        self.tracks = {}  # slot -> track
+        self.free = list(range(capacity - 1, -1, -1))
+
+    @property
+    def capacity(self):
+        return len(self.mean)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def allocate(self, track):
+        if len(self.free) == 0:
+            self._grow()
+        slot = self.free.pop()
+        self.tracks[slot] = track
+        return slot
+
+    def release(self, slot):
+        del self.tracks[slot]
+        self.free.append(slot)
+
+    def _grow(self):
+        capacity = self.capacity
+        mean = np.zeros((capacity * 2, 8))
+        covariance = np.zeros((capacity * 2, 8, 8))
+        mean[:capacity] = self.mean
+        covariance[:capacity] = self.covariance
+        self.mean = mean
+        self.covariance = covariance
+        self.free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def tlbr(self, slots):
+        """Bounding boxes `(min x, min y, max x, max y)` of the given slots."""
+        ret = self.mean[slots, :4].copy()
+        ret[:, 2] *= ret[:, 3]
+        ret[:, :2] -= ret[:, 2:] / 2
+        ret[:, 2:] += ret[:, :2]
+        return ret
@@ -1,5 +1,7 @@
 import sys
+import os
 import time
+import hashlib
 
 import numpy as np
 import cv2
@@ -15,11 +17,21 @@ from math_utils import softmax  # noqa: E402C
 # logger
 from logging import getLogger  # noqa: E402
 
-from simple_tokenizer import SimpleTokenizer as _Tokenizer
-
 logger = getLogger(__name__)
 
-_tokenizer = _Tokenizer()
+# created on first use, cached text features do not need it
+_tokenizer = None
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        from simple_tokenizer import SimpleTokenizer as _Tokenizer
+        cache_path = None
+        if TEXT_FEATURE_CACHE_DIR is not None:
+            cache_path = os.path.join(TEXT_FEATURE_CACHE_DIR, TOKENIZER_CACHE_NAME)
+        _tokenizer = _Tokenizer(BPE_VOCAB_PATH, cache_path=cache_path)
+    return _tokenizer
 
 # ======================
 # Parameters
@@ -37,6 +49,18 @@ REMOTE_PATH = 'https://storage.googleapis.com/ailia-models/clip/'
 
 IMAGE_SIZE = 224
 
+# maximum number of images encoded in one call, batches are padded to a
+# power of two so that the network only sees a few input shapes
+MAX_BATCH_SIZE = 8
+
+# vocabulary of the tokenizer, its contents are part of the text feature cache key
+BPE_VOCAB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bpe_simple_vocab_16e6.txt.gz')
+
+# text features are stored here per model and prompts, with the compiled
+# tokenizer tables, None disables the cache
+TEXT_FEATURE_CACHE_DIR = 'clip_text_feature_cache'
+TOKENIZER_CACHE_NAME = 'bpe_tables.json'
+
 model_type = 'ViTB32'
 #'RN50'
 
@@ -48,9 +72,10 @@ def tokenize(texts, context_length=77, truncate=False):
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
+    tokenizer = get_tokenizer()
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+    all_tokens = [[sot_token] + tokenizer.encode(text) + [eot_token] for text in texts]
     result = np.zeros((len(all_tokens), context_length), dtype=np.int64)
 
     for i, tokens in enumerate(all_tokens):
@@ -101,12 +126,28 @@ def preprocess(img):
 
 
 def predict(net, img, text_feature):
-    img = preprocess(img)
+    return predict_batch(net, [img], text_feature)[0]
 
-    # feedforward
-    output = net.predict([img])
 
-    image_feature = output[0]
+def predict_batch(net, imgs, text_feature):
+    image_features = []
+    for start in range(0, len(imgs), MAX_BATCH_SIZE):
+        chunk = imgs[start:start + MAX_BATCH_SIZE]
+        batch_size = 1
+        while batch_size < len(chunk):
+            batch_size = batch_size * 2
+        batch = np.zeros((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+        for i, img in enumerate(chunk):
+            batch[i] = preprocess(img)[0]
+
+        if tuple(net.get_input_shape()) != batch.shape:
+            net.set_input_shape(batch.shape)
+
+        # feedforward
+        output = net.predict([batch])
+        image_features.append(output[0][:len(chunk)])
+
+    image_feature = np.concatenate(image_features)
 
     image_feature = image_feature / np.linalg.norm(image_feature, ord=2, axis=-1, keepdims=True)
 
@@ -115,11 +156,12 @@ def predict(net, img, text_feature):
 
     pred = softmax(logits_per_image, axis=1)
 
-    return pred[0]
+    return pred
 
 
 def predict_text_feature(net, text):
-    text = tokenize(text)
+    if not isinstance(text, np.ndarray):
+        text = tokenize(text)
 
     # feedforward
     output = net.predict([text])
@@ -145,6 +187,57 @@ def recognize_clip(net_clip, img):
     return pred
 
 
+def recognize_clip_batch(net_clip, imgs):
+    # imgs are bgr format, returns the probabilities of each image (N, texts)
+    net_image = net_clip["net_image"]
+    text_feature = net_clip["text_feature"]
+
+    # inference
+    return predict_batch(net_image, imgs, text_feature)
+
+
+def text_feature_cache_path(texts):
+    # the tokens only depend on the prompts and the bpe vocabulary, so the
+    # prompts are used as key and the tokenizer is not needed on a hit
+    from simple_tokenizer import bpe_digest
+    key = hashlib.sha1()
+    key.update(model_type.encode("utf-8"))
+    key.update(bpe_digest(BPE_VOCAB_PATH).encode("utf-8"))
+    for text in texts:
+        key.update(b"\0" + text.encode("utf-8"))
+    return os.path.join(TEXT_FEATURE_CACHE_DIR, model_type + "_" + key.hexdigest() + ".npy")
+
+
+def load_text_feature(texts):
+    if TEXT_FEATURE_CACHE_DIR is None:
+        return None
+    path = text_feature_cache_path(texts)
+    if not os.path.exists(path):
+        return None
+    try:
+        text_feature = np.load(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring broken text feature cache " + path + " : " + str(e))
+        return None
+    if text_feature.ndim != 2 or text_feature.shape[0] != len(texts):
+        return None
+    return text_feature
+
+
+def save_text_feature(texts, text_feature):
+    if TEXT_FEATURE_CACHE_DIR is None:
+        return
+    path = text_feature_cache_path(texts)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(TEXT_FEATURE_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            np.save(f, text_feature)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Failed to write text feature cache " + path + " : " + str(e))
+
+
 def create_clip(text_inputs, env_id):
     dic_model = {
         'ViTB32': (
@@ -156,16 +249,27 @@ def create_clip(text_inputs, env_id):
     }
     (WEIGHT_IMAGE_PATH, MODEL_IMAGE_PATH), (WEIGHT_TEXT_PATH, MODEL_TEXT_PATH) = dic_model[model_type]
 
+    # the text encoder is only needed when the prompts are not cached yet
+    if isinstance(text_inputs, str):
+        text_inputs = [text_inputs]
+    text_feature = load_text_feature(text_inputs)
+
     # model files check and download
     logger.info('Checking encode_image model...')
     check_and_download_models(WEIGHT_IMAGE_PATH, MODEL_IMAGE_PATH, REMOTE_PATH)
-    logger.info('Checking encode_text model...')
-    check_and_download_models(WEIGHT_TEXT_PATH, MODEL_TEXT_PATH, REMOTE_PATH)
+    if text_feature is None:
+        logger.info('Checking encode_text model...')
+        check_and_download_models(WEIGHT_TEXT_PATH, MODEL_TEXT_PATH, REMOTE_PATH)
 
     memory_mode = ailia.get_memory_mode(
         reduce_constant=True, ignore_input_with_initializer=True,
         reduce_interstage=False, reuse_interstage=False)
     net_image = ailia.Net(MODEL_IMAGE_PATH, WEIGHT_IMAGE_PATH, env_id=env_id, memory_mode=memory_mode)
-    net_text = ailia.Net(MODEL_TEXT_PATH, WEIGHT_TEXT_PATH, env_id=env_id, memory_mode=memory_mode)
-    text_feature = predict_text_feature(net_text, text_inputs)
+    if text_feature is None:
+        net_text = ailia.Net(MODEL_TEXT_PATH, WEIGHT_TEXT_PATH, env_id=env_id, memory_mode=memory_mode)
+        text_feature = predict_text_feature(net_text, text_inputs)
+        save_text_feature(text_inputs, text_feature)
+    else:
+        logger.info('Using cached text features.')
+        net_text = None
     return {"net_image":net_image, "net_text":net_text, "text_feature":text_feature}
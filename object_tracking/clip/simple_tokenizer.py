@@ -1,5 +1,7 @@
 import gzip
+import hashlib
 import html
+import json
 import os
 from functools import lru_cache
 
@@ -35,6 +37,68 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
+# bump when the layout of the compiled tables changes
+TABLES_CACHE_VERSION = 1
+
+
+def load_tables(bpe_path):
+    """
+    Build the encoder and the merge ranks from the gzipped bpe merges file.
+    """
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152 - 256 - 2 + 1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v + '</w>' for v in vocab]
+
+    for merge in merges:
+        vocab.append(''.join(merge))
+
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+
+    encoder = dict(zip(vocab, range(len(vocab))))
+    bpe_ranks = dict(zip(merges, range(len(merges))))
+    return encoder, bpe_ranks
+
+
+@lru_cache()
+def bpe_digest(bpe_path):
+    """
+    Hash of the contents of the merges file, to key the caches built from it.
+    """
+    with open(bpe_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_cached_tables(bpe_path, cache_path):
+    """
+    Same as load_tables, but the tables are kept precompiled as json in
+    cache_path. The cache is rebuilt when the contents of the merges file
+    change, and is skipped when it can not be written.
+    """
+    key = [TABLES_CACHE_VERSION, bpe_digest(bpe_path)]
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            vocab = cached["vocab"]
+            merges = [tuple(merge) for merge in cached["merges"]]
+            return dict(zip(vocab, range(len(vocab)))), dict(zip(merges, range(len(merges))))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    encoder, bpe_ranks = load_tables(bpe_path)
+    tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "vocab": list(encoder), "merges": list(bpe_ranks)}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return encoder, bpe_ranks
+
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
     Word is represented as tuple of symbols (symbols being variable-length strings).
@@ -60,29 +124,34 @@ def whitespace_clean(text):
 
 
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_path: str = None):
         self.byte_encoder = bytes_to_unicode()
-        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152 - 256 - 2 + 1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v + '</w>' for v in vocab]
-
-        for merge in merges:
-            vocab.append(''.join(merge))
 
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
-
-        self.encoder = dict(zip(vocab, range(len(vocab))))
-        self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
+        # the tables are only cached when a cache_path is given
+        if cache_path:
+            self.encoder, self.bpe_ranks = load_cached_tables(bpe_path, cache_path)
+        else:
+            self.encoder, self.bpe_ranks = load_tables(bpe_path)
+        self._decoder = None
+        self._byte_decoder = None
         self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
         self.pat = re.compile(
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             re.IGNORECASE)
 
+    @property
+    def decoder(self):
+        # only needed by decode, built on first use
+        if self._decoder is None:
+            self._decoder = {v: k for k, v in self.encoder.items()}
+        return self._decoder
+
+    @property
+    def byte_decoder(self):
+        if self._byte_decoder is None:
+            self._byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        return self._byte_decoder
+
     def bpe(self, token):
         if token in self.cache:
             return self.cache[token]
@@ -0,0 +1,205 @@
+"""
+Check of the analytics sender against a local HTTP stand-in server for
+the measurement protocol endpoint. Batching, retries with backoff,
+rejected requests and the time taken by close are checked, and with the
+disk spool, the delivery after an outage and the bound of its size.
+
+    python3 analytics_check.py
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../object_tracking/bytetrack'))
+from analytics_utils import AnalyticsSender, EventSpool  # noqa: E402
+
+
+# ======================
+# Stand-in server
+# ======================
+
+class StandInServer(object):
+    """Local endpoint which records the posted payloads.
+
+    `statuses` are answered to the next requests in order, 204 after them.
+    With `hang`, requests are never answered until the server is closed.
+    """
+
+    def __init__(self, statuses=(), hang=False):
+        self.statuses = list(statuses)
+        self.hang = hang
+        self.payloads = []
+        self.times = []
+        self.release = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if server.hang:
+                    server.release.wait()
+                    return
+                server.times.append(time.monotonic())
+                status = server.statuses.pop(0) if len(server.statuses) > 0 else 204
+                if 200 <= status < 300:
+                    server.payloads.append(json.loads(body))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.endpoint = 'http://127.0.0.1:%d/mp/collect' % self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def events(self):
+        return [event for payload in self.payloads for event in payload['events']]
+
+    def close(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def create_sender(server, **kwargs):
+    return AnalyticsSender('secret', 'G-TEST', endpoint=server.endpoint, **kwargs)
+
+
+def send_events(sender, n):
+    for i in range(n):
+        sender.send('count', {'i': i})
+
+
+# ======================
+# Checks
+# ======================
+
+def check_batching():
+    server = StandInServer()
+    sender = create_sender(server, flush_interval=0.2)
+    send_events(sender, 60)
+    sender.close()
+    server.close()
+    sizes = [len(payload['events']) for payload in server.payloads]
+    clients = set(payload['client_id'] for payload in server.payloads)
+    order = [event['params']['i'] for event in server.events()]
+    return sizes == [25, 25, 10] and len(clients) == 1 and order == list(range(60)), \
+        'batches %s, %d client ids' % (sizes, len(clients))
+
+
+def check_retry():
+    server = StandInServer(statuses=[503, 503])
+    sender = create_sender(server, flush_interval=0.1, backoff=0.1)
+    send_events(sender, 10)
+    sender.close()
+    server.close()
+    # 0.1s then 0.2s between the attempts
+    waits = [b - a for a, b in zip(server.times, server.times[1:])]
+    ok = sender.sent == 10 and sender.failed == 0 and len(waits) == 2 and waits[0] >= 0.1 and waits[1] >= 0.2
+    return ok, 'sent %d after %d requests, waits %s' % (
+        sender.sent, len(server.times), ['%.2f' % w for w in waits])
+
+
+def check_rejected():
+    server = StandInServer(statuses=[400])
+    sender = create_sender(server, flush_interval=0.1)
+    send_events(sender, 5)
+    sender.close()
+    server.close()
+    return sender.failed == 5 and len(server.times) == 1, \
+        'failed %d after %d requests' % (sender.failed, len(server.times))
+
+
+def check_bounded_close():
+    # the endpoint never answers, and the queue is filled while the first
+    # batch is in flight
+    server = StandInServer(hang=True)
+    sender = create_sender(server, flush_interval=0.1, timeout=1.0, queue_size=50)
+    send_events(sender, 25)
+    time.sleep(0.2)
+    send_events(sender, 75)
+    start = time.monotonic()
+    sender.close(timeout=0.5)
+    elapsed = time.monotonic() - start
+    server.close()
+    # the close timeout and at most the request in flight
+    ok = elapsed < 0.5 + 1.0 + 0.5 and sender.sent + sender.failed + sender.dropped == 100
+    return ok, 'closed in %.2fs, %d failed, %d dropped' % (elapsed, sender.failed, sender.dropped)
+
+
+def check_spool_outage():
+    # the endpoint is down for the first run, the events are sent by the next one
+    directory = tempfile.mkdtemp()
+    try:
+        server = StandInServer(statuses=[503] * 1000)
+        sender = create_sender(server, flush_interval=0.1, backoff=0.05, max_backoff=0.1,
+                               spool=EventSpool(directory, segment_bytes=2048))
+        send_events(sender, 100)
+        time.sleep(0.3)
+        sender.close(timeout=0.5)
+        server.close()
+        first_sent = sender.sent
+
+        server = StandInServer()
+        sender = create_sender(server, flush_interval=0.1, spool=EventSpool(directory, segment_bytes=2048))
+        sender.close()
+        server.close()
+        order = [event['params']['i'] for event in server.events()]
+        stamped = all('timestamp_micros' in payload for payload in server.payloads)
+        ok = first_sent == 0 and order == list(range(100)) and stamped
+        return ok, 'sent %d in the first run, %d in order in the next' % (first_sent, len(order))
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_spool_bound():
+    # a bound smaller than two default segments
+    directory = tempfile.mkdtemp()
+    try:
+        max_bytes = 16 * 1024
+        spool = EventSpool(directory, max_bytes=max_bytes)
+        largest = 0
+        for i in range(2000):
+            spool.append({'name': 'count', 'params': {'i': i}})
+            spool.sync(force=True)
+            size = sum(os.path.getsize(os.path.join(directory, name))
+                       for name in os.listdir(directory) if name.endswith('.log'))
+            largest = max(largest, size)
+        events, _, _, _ = spool.read(2000)
+        spool.close()
+        ok = largest <= max_bytes and events[-1]['params']['i'] == i and spool.dropped + len(events) == i + 1
+        return ok, 'largest size %d of %d bytes, %d dropped' % (largest, max_bytes, spool.dropped)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    # the errors of the failed requests are expected
+    logging.getLogger('analytics_utils').setLevel(logging.CRITICAL)
+    ok = True
+    for name, check in (
+            ('batching', check_batching),
+            ('retry', check_retry),
+            ('rejected', check_rejected),
+            ('bounded close', check_bounded_close),
+            ('spool outage', check_spool_outage),
+            ('spool bound', check_spool_bound)):
+        passed, detail = check()
+        print(f'{name:16s} {"ok" if passed else "FAILED":6s} {detail}')
+        ok = ok and passed
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Micro benchmark of LineCrossingCounter with and without the line grid.
+The counts and states of both are checked to be identical, in the history
+and the incremental mode, before timing.
+
+    python3 crossing_benchmark.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../object_tracking/bytetrack'))
+from crossing_utils import LineCrossingCounter  # noqa: E402
+
+FRAME_W = 1920
+FRAME_H = 1080
+# positions and lines are snapped to this many pixels, so that tracks are
+# often exactly on a line or on its extension
+SNAP = 8
+
+
+# ======================
+# Scene
+# ======================
+
+def random_lines(rs, n, length):
+    lines = []
+    for _ in range(n):
+        center = rs.rand(2) * (FRAME_W, FRAME_H)
+        angle = rs.choice([0, np.pi / 2, rs.rand() * np.pi])
+        d = np.array([np.cos(angle), np.sin(angle)]) * length / 2
+        normal = np.array([-d[1], d[0]]) * 0.2
+        points = [center - d, center + d, center - d + normal, center + d + normal]
+        points = [(int(p[0]) // SNAP * SNAP, int(p[1]) // SNAP * SNAP) for p in points]
+        lines.append({"lines": points})
+    return lines
+
+
+def random_frames(rs, num_tracks, num_frames):
+    """Track ids and centers of each frame, and the ids removed after each frame."""
+    positions = rs.rand(num_tracks, 2) * (FRAME_W, FRAME_H)
+    velocities = rs.randn(num_tracks, 2) * 6
+    ids = np.arange(num_tracks)
+    next_id = num_tracks
+    frames = []
+    for _ in range(num_frames):
+        velocities += rs.randn(num_tracks, 2)
+        positions += velocities
+        centers = (positions.astype(int) // SNAP * SNAP).tolist()
+        visible = rs.rand(num_tracks) > 0.05
+        track_ids = ids[visible].tolist()
+        centers = [c for c, v in zip(centers, visible) if v]
+
+        # tracks leaving the frame are replaced by new ones
+        out = (positions[:, 0] < 0) | (positions[:, 0] > FRAME_W) | (positions[:, 1] < 0) | (positions[:, 1] > FRAME_H)
+        removed = ids[out].tolist()
+        for i in np.nonzero(out)[0]:
+            positions[i] = rs.rand(2) * (FRAME_W, FRAME_H)
+            ids[i] = next_id
+            next_id = next_id + 1
+        frames.append((track_ids, centers, removed))
+    return frames
+
+
+def run(counter, frames):
+    results = []
+    for frame_no, (track_ids, centers, removed) in enumerate(frames):
+        r = counter.update(track_ids, centers, frame_no)
+        results.append((r["countup_in"], r["countup_out"], r["state"], r["dark_from"]))
+        counter.remove(removed)
+    return results
+
+
+# ======================
+# Benchmark
+# ======================
+
+def main():
+    rs = np.random.RandomState(0)
+    ok = True
+    for num_lines, length in ((4, 400), (20, 200), (60, 80)):
+        lines = random_lines(rs, num_lines, length)
+        frames = random_frames(rs, 100, 300)
+        for mode in ('history', 'incremental'):
+            t = time.perf_counter()
+            a = run(LineCrossingCounter(lines, mode=mode), frames)
+            t_all = time.perf_counter() - t
+            t = time.perf_counter()
+            b = run(LineCrossingCounter(lines, mode=mode, grid_size=64), frames)
+            t_grid = time.perf_counter() - t
+
+            same = all(np.array_equal(x, y) for ra, rb in zip(a, b) for x, y in zip(ra, rb))
+            counts = sum(int(r[0].sum() + r[1].sum()) for r in a)
+            name = f'{mode} lines={num_lines:3d}'
+            if not same:
+                print(f'{name:24s} OUTPUT MISMATCH')
+                ok = False
+                continue
+            print(f'{name:24s} counts {counts:4d}  all lines {t_all * 1000:8.1f} ms  grid {t_grid * 1000:8.1f} ms'
+                  f'  x{t_all / t_grid:5.1f}')
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
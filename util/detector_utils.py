@@ -37,7 +37,7 @@ def hsv_to_rgb(h, s, v):
     return (int(bgr[0]), int(bgr[1]), int(bgr[2]), 255)
 
 
-def letterbox_convert(frame, det_shape):
+def letterbox_convert(frame, det_shape, out=None):
     """
     Adjust the size of the frame from the webcam to the ailia input shape.
 
@@ -46,6 +46,8 @@ def letterbox_convert(frame, det_shape):
     frame: numpy array
     det_shape: tuple
         ailia model input (height,width)
+    out: numpy array, optional
+        uint8 (height,width,3) buffer to write into, reused between calls
 
     Returns
     -------
@@ -56,18 +58,25 @@ def letterbox_convert(frame, det_shape):
     f_height, f_width = frame.shape[0], frame.shape[1]
     scale = np.max((f_height / height, f_width / width))
 
-    # padding base
-    img = np.zeros(
-        (int(round(scale * height)), int(round(scale * width)), 3),
-        np.uint8
-    )
-    start = (np.array(img.shape) - np.array(frame.shape)) // 2
-    img[
-        start[0]: start[0] + f_height,
-        start[1]: start[1] + f_width
-    ] = frame
-    resized_img = cv2.resize(img, (width, height))
-    return resized_img
+    # resize first and pad at the detector resolution, the offsets are the
+    # ones expected by reverse_letterbox
+    start_y = int((height - f_height / scale) // 2)
+    start_x = int((width - f_width / scale) // 2)
+    r_height = max(1, min(int(round(f_height / scale)), height - start_y))
+    r_width = max(1, min(int(round(f_width / scale)), width - start_x))
+
+    if out is None:
+        out = np.zeros((height, width, 3), np.uint8)
+    else:
+        out[:start_y] = 0
+        out[start_y + r_height:] = 0
+        out[start_y:start_y + r_height, :start_x] = 0
+        out[start_y:start_y + r_height, start_x + r_width:] = 0
+    out[
+        start_y: start_y + r_height,
+        start_x: start_x + r_width
+    ] = cv2.resize(frame[:, :, :3], (r_width, r_height))
+    return out
 
 
 def reverse_letterbox(detections, img, det_shape):
@@ -0,0 +1,184 @@
+"""
+Micro benchmark of the vectorized NMS functions against the previous
+loop implementations, which are kept here as reference. The outputs are
+checked to be identical before timing.
+
+    python3 nms_benchmark.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../object_tracking/age-gender-retail'))
+from nms_utils import bb_intersection_over_union, nms_boxes, packed_nms  # noqa: E402
+from blazeface_utils import weighted_non_max_suppression  # noqa: E402
+
+
+# ======================
+# Reference implementations
+# ======================
+
+def reference_nms_boxes(boxes, scores, iou_thres):
+    keep = []
+    for i, box_a in enumerate(boxes):
+        is_keep = True
+        for j in range(i):
+            if not keep[j]:
+                continue
+            box_b = boxes[j]
+            iou = bb_intersection_over_union(box_a, box_b)
+            if iou >= iou_thres:
+                if scores[i] > scores[j]:
+                    keep[j] = False
+                else:
+                    is_keep = False
+                    break
+
+        keep.append(is_keep)
+
+    return np.array(keep).nonzero()[0]
+
+
+def reference_packed_nms(boxes, scores, iou_thres):
+    packed_idx = []
+    remained = np.argsort(-scores)
+    while 0 < len(remained):
+        idx = remained
+        i = idx[0]
+        candidates = [i]
+        remained = []
+        for j in idx[1:]:
+            similarity = bb_intersection_over_union(boxes[i], boxes[j])
+            if similarity > iou_thres:
+                candidates.append(j)
+            else:
+                remained.append(j)
+
+        packed_idx.append(candidates)
+
+    return packed_idx
+
+
+def reference_jaccard(box_a, box_b):
+    A = box_a.shape[0]
+    B = box_b.shape[0]
+    max_xy = np.minimum(
+        np.repeat(np.expand_dims(box_a[:, 2:], axis=1), B, axis=1),
+        np.repeat(np.expand_dims(box_b[:, 2:], axis=0), A, axis=0),
+    )
+    min_xy = np.maximum(
+        np.repeat(np.expand_dims(box_a[:, :2], axis=1), B, axis=1),
+        np.repeat(np.expand_dims(box_b[:, :2], axis=0), A, axis=0),
+    )
+    inter = np.clip((max_xy - min_xy), 0, None)
+    inter = inter[:, :, 0] * inter[:, :, 1]
+    area_a = np.repeat(np.expand_dims(
+        (box_a[:, 2]-box_a[:, 0]) * (box_a[:, 3]-box_a[:, 1]), axis=1), inter.shape[1], axis=1)
+    area_b = np.repeat(np.expand_dims(
+        (box_b[:, 2]-box_b[:, 0]) * (box_b[:, 3]-box_b[:, 1]), axis=0), inter.shape[0], axis=0)
+    union = area_a + area_b - inter
+    return inter / union
+
+
+def reference_weighted_non_max_suppression(detections):
+    min_suppression_threshold = 0.3
+    if len(detections) == 0:
+        return []
+
+    output_detections = []
+    remaining = np.argsort(-detections[:, 16])
+    while len(remaining) > 0:
+        detection = detections[remaining[0]]
+        first_box = detection[:4]
+        other_boxes = detections[remaining, :4]
+        ious = reference_jaccard(np.expand_dims(first_box, axis=0), other_boxes).squeeze(0)
+
+        mask = ious > min_suppression_threshold
+        overlapping = remaining[mask]
+        remaining = remaining[~mask]
+
+        weighted_detection = detection.copy()
+        if len(overlapping) > 1:
+            coordinates = detections[overlapping, :16]
+            scores = detections[overlapping, 16:17]
+            total_score = scores.sum()
+            weighted = (coordinates * scores).sum(axis=0) / total_score
+            weighted_detection[:16] = weighted
+            weighted_detection[16] = total_score / len(overlapping)
+
+        output_detections.append(weighted_detection)
+
+    return output_detections
+
+
+# ======================
+# Benchmark
+# ======================
+
+def random_boxes(rs, n, size, dtype=np.float32):
+    # clustered boxes, so that a good part of them overlap
+    centers = rs.rand(max(1, n // 8), 2) * size
+    xy = centers[rs.randint(len(centers), size=n)] + rs.randn(n, 2) * size * 0.02
+    wh = rs.rand(n, 2) * size * 0.1 + size * 0.02
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1).astype(dtype)
+    scores = rs.rand(n).astype(dtype)
+    return boxes, scores
+
+
+def random_face_detections(rs, n):
+    boxes, scores = random_boxes(rs, n, 1.0)
+    keypoints = rs.rand(n, 12).astype(np.float32)
+    return np.concatenate([boxes[:, [1, 0, 3, 2]], keypoints, scores[:, None]], axis=1)
+
+
+def measure(func, args, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def report(name, n, reference, vectorized, args, same, repeat):
+    if not same:
+        print(f'{name:28s} n={n:5d} OUTPUT MISMATCH')
+        return False
+    t_ref = measure(reference, args, repeat)
+    t_vec = measure(vectorized, args, repeat)
+    print(f'{name:28s} n={n:5d} reference {t_ref:9.3f} ms  vectorized {t_vec:9.3f} ms  x{t_ref / t_vec:6.1f}')
+    return True
+
+
+def main():
+    rs = np.random.RandomState(0)
+    ok = True
+    for n in (10, 100, 500):
+        repeat = 20 if n < 500 else 3
+        boxes, scores = random_boxes(rs, n, 672)
+        for name, reference, vectorized in (
+                ('nms_boxes', reference_nms_boxes, nms_boxes),
+                ('packed_nms', reference_packed_nms, packed_nms)):
+            args = (boxes, scores, 0.5)
+            a = reference(*args)
+            b = vectorized(*args)
+            if isinstance(a, list):
+                same = len(a) == len(b) and all(list(x) == list(y) for x, y in zip(a, b))
+            else:
+                same = np.array_equal(a, b)
+            ok = report(name, n, reference, vectorized, args, same, repeat) and ok
+
+        detections = random_face_detections(rs, n)
+        a = reference_weighted_non_max_suppression(detections)
+        b = weighted_non_max_suppression(detections)
+        same = len(a) == len(b) and all(np.array_equal(x, y) for x, y in zip(a, b))
+        ok = report('weighted_non_max_suppression', n, reference_weighted_non_max_suppression,
+                    weighted_non_max_suppression, (detections,), same, repeat) and ok
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,19 @@ def bb_intersection_over_union(boxA, boxB):
     return iou
 
 
+def bb_intersection_over_union_many(box, boxes):
+    # same as bb_intersection_over_union of box against every row of boxes
+    xA = np.maximum(box[0], boxes[:, 0])
+    yA = np.maximum(box[1], boxes[:, 1])
+    xB = np.minimum(box[2], boxes[:, 2])
+    yB = np.minimum(box[3], boxes[:, 3])
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+    boxAArea = (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+    boxBArea = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    union = (boxAArea + boxBArea - interArea).astype(np.float64)
+    return interArea / union
+
+
 def nms_between_categories(detections, w, h, categories=None, iou_threshold=0.25):
     # Normally darknet use per class nms
     # But some cases need between class nms
@@ -57,25 +70,30 @@ def nms_between_categories(detections, w, h, categories=None, iou_threshold=0.25
 
 def nms_boxes(boxes, scores, iou_thres):
     # Performs non-maximum suppression (NMS) on the boxes according to their intersection-over-union (IoU).
-
-    keep = []
-    for i, box_a in enumerate(boxes):
-        is_keep = True
-        for j in range(i):
-            if not keep[j]:
-                continue
-            box_b = boxes[j]
-            iou = bb_intersection_over_union(box_a, box_b)
-            if iou >= iou_thres:
-                if scores[i] > scores[j]:
-                    keep[j] = False
-                else:
-                    is_keep = False
-                    break
-
-        keep.append(is_keep)
-
-    return np.array(keep).nonzero()[0]
+    # Each box is compared with the kept boxes before it in index order: it
+    # removes the overlapping ones with a lower score until it meets one
+    # with a higher or equal score, which removes it instead.
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+
+    keep = np.zeros(len(boxes), dtype=bool)
+    kept = np.zeros(0, dtype=int)  # indices of the kept boxes, ascending
+    for i in range(len(boxes)):
+        if len(kept) == 0:
+            keep[i] = True
+            kept = np.array([i])
+            continue
+        iou = bb_intersection_over_union_many(boxes[i], boxes[kept])
+        overlap = kept[iou >= iou_thres]
+        lose = np.flatnonzero(~(scores[i] > scores[overlap]))
+        if len(lose) > 0:
+            keep[overlap[:lose[0]]] = False
+        else:
+            keep[overlap] = False
+            keep[i] = True
+        kept = np.flatnonzero(keep[:i + 1])
+
+    return keep.nonzero()[0]
 
 
 def batched_nms(boxes, scores, labels, iou_thres):
@@ -96,20 +114,16 @@ def batched_nms(boxes, scores, labels, iou_thres):
 
 
 def packed_nms(boxes, scores, iou_thres):
+    boxes = np.asarray(boxes)
+
     packed_idx = []
     remained = np.argsort(-scores)
     while 0 < len(remained):
-        idx = remained
-        i = idx[0]
-        candidates = [i]
-        remained = []
-        for j in idx[1:]:
-            similarity = bb_intersection_over_union(boxes[i], boxes[j])
-            if similarity > iou_thres:
-                candidates.append(j)
-            else:
-                remained.append(j)
-
-        packed_idx.append(candidates)
+        i = remained[0]
+        rest = remained[1:]
+        similarity = bb_intersection_over_union_many(boxes[i], boxes[rest])
+        mask = similarity > iou_thres
+        packed_idx.append([i] + list(rest[mask]))
+        remained = rest[~mask]
 
     return packed_idx